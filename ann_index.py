@@ -0,0 +1,178 @@
+import torch
+import numpy as np
+import argparse
+import time
+from utils import load_triples
+
+ltensor = torch.LongTensor
+
+def load_entity_tables(path):
+    ''' Entity table, TransD projection scalars (e . e_transfer) and relation
+    tables of a saved TransE/TransD checkpoint (D_epoch*.pts). Rows are
+    renormalized as nn.Embedding(max_norm=1) would on lookup '''
+    state = torch.load(path, map_location='cpu')
+    renorm = lambda w: w.renorm(2, 0, 1)
+    if '_ent_embeds.weight' in state:
+        ents = renorm(state['_ent_embeds.weight'])
+        scalars = (ents * renorm(state['ent_transfer.weight'])).sum(dim=1)
+        rel_ts = renorm(state['rel_transfer.weight'])
+    else:
+        ents = renorm(state['ent_embeds.weight'])
+        scalars, rel_ts = None, None
+    rel_es = renorm(state['rel_embeds.weight'])
+    return ents, scalars, rel_es, rel_ts
+
+def kmeans(data, num_clusters, num_iters=20, chunk_size=65536, seed=0):
+    ''' Lloyd's k-means (L2) on the rows of `data`, returns assignments '''
+    gen = torch.Generator().manual_seed(seed)
+    centroids = data[torch.randperm(len(data), generator=gen)[:num_clusters]].clone()
+    for _ in range(num_iters):
+        assign = torch.cat([torch.cdist(data[i:i+chunk_size], centroids).argmin(dim=1)\
+                for i in range(0, len(data), chunk_size)])
+        sums = torch.zeros_like(centroids).index_add_(0, assign, data)
+        counts = torch.bincount(assign, minlength=num_clusters)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled].unsqueeze(1).float()
+    return assign
+
+class IVFIndex(object):
+    ''' Inverted-file index over an entity table for translational scores
+    ||q - e||_p, where q is h + r (tail queries) or t - r (head queries).
+    For TransD the candidates are P_r(e) = e + s_e * r_transfer; since that
+    is linear in e, the lists are clustered once on the raw table and each
+    list centroid is projected per query as c + mean(s) * r_transfer '''
+    def __init__(self, ents, scalars=None, p=2, num_lists=None, num_iters=20, seed=0):
+        self.ents = ents
+        self.scalars = scalars
+        self.p = p
+        if num_lists is None:
+            num_lists = int(np.sqrt(len(ents)))
+        assign = kmeans(ents, num_lists, num_iters=num_iters, seed=seed)
+
+        counts = torch.bincount(assign, minlength=num_lists)
+        self.order = torch.argsort(assign)
+        self.ptr = torch.cat([ltensor([0]), counts.cumsum(0)])
+        fcounts = counts.clamp(min=1).unsqueeze(1).float()
+        self.centroids = torch.zeros(num_lists, ents.size(1)).index_add_(0, assign, ents) / fcounts
+        self.cent_scalars = None
+        if scalars is not None:
+            self.cent_scalars = torch.zeros(num_lists).index_add_(0, assign, scalars) / fcounts.view(-1)
+
+    @classmethod
+    def from_checkpoint(cls, path, p=2, num_lists=None, num_iters=20, seed=0):
+        ents, scalars, rel_es, rel_ts = load_entity_tables(path)
+        index = cls(ents, scalars, p=p, num_lists=num_lists, num_iters=num_iters, seed=seed)
+        return index, rel_es, rel_ts
+
+    def _candidates(self, idxs, rel_t):
+        cands = self.ents[idxs]
+        if self.scalars is not None:
+            cands = cands + self.scalars[idxs].unsqueeze(1) * rel_t
+        return cands
+
+    def search(self, queries, k=10, nprobe=8, rel_ts=None):
+        ''' (distances, entity ids) of the approximate k nearest candidates
+        of each query, scanning the nprobe closest lists. rel_ts holds the
+        per-query TransD relation transfer vectors '''
+        centroids = self.centroids.unsqueeze(0)
+        if self.cent_scalars is not None:
+            centroids = centroids + self.cent_scalars.view(1, -1, 1) * rel_ts.unsqueeze(1)
+        coarse = (queries.unsqueeze(1) - centroids).norm(p=self.p, dim=2)
+        probes = coarse.topk(min(nprobe, len(self.centroids)), dim=1, largest=False)[1]
+
+        dists = torch.full((len(queries), k), float('inf'))
+        idxs = torch.full((len(queries), k), -1, dtype=torch.long)
+        for i, lists in enumerate(probes.tolist()):
+            members = torch.cat([self.order[self.ptr[l]:self.ptr[l+1]] for l in lists])
+            rel_t = None if rel_ts is None else rel_ts[i]
+            d = (queries[i] - self._candidates(members, rel_t)).norm(p=self.p, dim=1)
+            top = d.topk(min(k, len(d)), largest=False)
+            dists[i, :len(top[0])] = top[0]
+            idxs[i, :len(top[1])] = members[top[1]]
+        return dists, idxs
+
+    def exact_search(self, queries, k=10, rel_ts=None, chunk_size=8192):
+        ''' Brute force counterpart of search, sweeping the table in chunks '''
+        best_d = torch.full((len(queries), 0), float('inf'))
+        best_i = torch.zeros(len(queries), 0, dtype=torch.long)
+        for start in range(0, len(self.ents), chunk_size):
+            idxs = torch.arange(start, min(start + chunk_size, len(self.ents)))
+            cands = self.ents[idxs].unsqueeze(0)
+            if self.scalars is not None:
+                cands = cands + self.scalars[idxs].view(1, -1, 1) * rel_ts.unsqueeze(1)
+            d = (queries.unsqueeze(1) - cands).norm(p=self.p, dim=2)
+            best_d = torch.cat([best_d, d], dim=1)
+            best_i = torch.cat([best_i, idxs.expand(len(queries), -1)], dim=1)
+            best_d, top = best_d.topk(min(k, best_d.size(1)), dim=1, largest=False)
+            best_i = best_i.gather(1, top)
+        return best_d, best_i
+
+def tail_queries(triplets, ents, scalars, rel_es, rel_ts):
+    ''' Queries h + r (projected for TransD) answering (h, r, ?) '''
+    lhs = ents[triplets[:, 0]]
+    q_rel_ts = None
+    if scalars is not None:
+        q_rel_ts = rel_ts[triplets[:, 1]]
+        lhs = lhs + scalars[triplets[:, 0]].unsqueeze(1) * q_rel_ts
+    return lhs + rel_es[triplets[:, 1]], q_rel_ts
+
+def head_queries(triplets, ents, scalars, rel_es, rel_ts):
+    ''' Queries t - r (projected for TransD) answering (?, r, t): the energy
+    ||P(h) + r - P(t)|| is the distance of P(h) to P(t) - r '''
+    rhs = ents[triplets[:, 2]]
+    q_rel_ts = None
+    if scalars is not None:
+        q_rel_ts = rel_ts[triplets[:, 1]]
+        rhs = rhs + scalars[triplets[:, 2]].unsqueeze(1) * q_rel_ts
+    return rhs - rel_es[triplets[:, 1]], q_rel_ts
+
+def recall_at_k(approx_idxs, exact_idxs):
+    ''' Fraction of the exact top-k found by the approximate search '''
+    hits = (approx_idxs.unsqueeze(2) == exact_idxs.unsqueeze(1)).any(dim=1)
+    return hits.float().mean().item()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True, help='Saved D_epoch*.pts of a TransE or TransD model')
+    parser.add_argument('--triplets', type=str, default=None, help='Query triplets, e.g. the parsed test split as .npy or .pkl (default: random triplets)')
+    parser.add_argument('--side', type=str, default='both', choices=['head', 'tail', 'both'], help='Answer (?, r, t) with t - r queries, (h, r, ?) with h + r queries, or both (default: both)')
+    parser.add_argument('--p', type=int, default=2, help='Norm of the translational score (default: 2)')
+    parser.add_argument('--num_lists', type=int, default=None, help='Number of k-means lists (default: sqrt(num_ent))')
+    parser.add_argument('--nprobe', type=int, default=8, help='Lists scanned per query (default: 8)')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours returned per query (default: 10)')
+    parser.add_argument('--num_queries', type=int, default=1000, help='Queries used to measure recall (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    return parser.parse_args()
+
+def main(args):
+    torch.manual_seed(args.seed)
+    start = time.time()
+    index, rel_es, rel_ts = IVFIndex.from_checkpoint(args.checkpoint, p=args.p,\
+            num_lists=args.num_lists, seed=args.seed)
+    print("Built %d lists over %d entities in %.2fs" % (len(index.centroids),\
+            len(index.ents), time.time() - start))
+
+    if args.triplets is not None:
+        triplets = torch.from_numpy(np.array(load_triples(args.triplets), dtype=np.int64))
+        triplets = triplets[torch.randperm(len(triplets))[:args.num_queries]]
+    else:
+        triplets = torch.stack([torch.randint(len(index.ents), (args.num_queries,)),\
+                torch.randint(len(rel_es), (args.num_queries,)),\
+                torch.randint(len(index.ents), (args.num_queries,))], dim=1)
+
+    sides = {'head': head_queries, 'tail': tail_queries}
+    for side in (['head', 'tail'] if args.side == 'both' else [args.side]):
+        queries, q_rel_ts = sides[side](triplets, index.ents, index.scalars, rel_es, rel_ts)
+
+        start = time.time()
+        _, approx = index.search(queries, k=args.k, nprobe=args.nprobe, rel_ts=q_rel_ts)
+        approx_ms = 1000 * (time.time() - start) / len(queries)
+        start = time.time()
+        _, exact = index.exact_search(queries, k=args.k, rel_ts=q_rel_ts)
+        exact_ms = 1000 * (time.time() - start) / len(queries)
+
+        print("%s queries, Recall@%d: %f" % (side, args.k, recall_at_k(approx, exact)))
+        print("%s queries, per query: IVF %.3fms, exact %.3fms" % (side, approx_ms, exact_ms))
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,96 @@
+import torch
+import torch.multiprocessing as mp
+import copy
+import glob
+import json
+import time
+import os
+
+STOP = 'STOP'
+
+def submit_checkpoint(queue_dir, epoch, modules):
+    ''' Drop the weights of `modules` (name -> nn.Module or None) into the
+    queue. The file is renamed into place so the worker never sees a
+    partial checkpoint '''
+    state = {name: m.state_dict() for name, m in modules.items() if m is not None}
+    path = os.path.join(queue_dir, 'epoch%06d.pts' % epoch)
+    torch.save({'epoch': epoch, 'state': state}, path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+def load_metrics(queue_dir):
+    ''' Metrics written back by the worker so far, keyed by epoch '''
+    metrics = {}
+    for path in sorted(glob.glob(os.path.join(queue_dir, 'epoch*_metrics.json'))):
+        with open(path) as f:
+            m = json.load(f)
+        metrics[m['epoch']] = m
+    return metrics
+
+def drain_metrics(queue_dir, seen):
+    ''' Worker metrics of epochs not in `seen` yet, oldest first. Their
+    epochs are added to `seen`, so each result is returned once '''
+    fresh = [m for epoch, m in sorted(load_metrics(queue_dir).items())\
+            if epoch not in seen]
+    seen.update(m['epoch'] for m in fresh)
+    return fresh
+
+def log_metrics(experiment, metrics):
+    ''' Print one epoch of worker metrics and log them to comet at that
+    epoch '''
+    epoch = metrics['epoch']
+    values = sorted((k, float(v)) for k, v in metrics.items() if k != 'epoch')
+    print("Async validation of epoch %d: %s" % (epoch,\
+            ', '.join('%s %f' % kv for kv in values)))
+    for name, value in values:
+        experiment.log_metric(name, value, step=epoch)
+
+def run_worker(queue_dir, evaluate, modules, eval_args, device, poll=5):
+    ''' Evaluate queued checkpoints oldest first until STOP is dropped and
+    the queue is empty. `evaluate(epoch, modules, *eval_args)` returns a
+    dict of metrics, written next to the queue as epoch*_metrics.json '''
+    for m in modules.values():
+        if m is not None:
+            m.to(device)
+
+    while True:
+        pending = sorted(glob.glob(os.path.join(queue_dir, 'epoch*.pts')))
+        if not pending:
+            if os.path.exists(os.path.join(queue_dir, STOP)):
+                break
+            time.sleep(poll)
+            continue
+
+        ckpt = torch.load(pending[0], map_location=device)
+        for name, state in ckpt['state'].items():
+            modules[name].load_state_dict(state)
+        metrics = evaluate(ckpt['epoch'], modules, *eval_args)
+        metrics['epoch'] = ckpt['epoch']
+
+        path = os.path.join(queue_dir, 'epoch%06d_metrics.json' % ckpt['epoch'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(metrics, f, default=float)
+        os.rename(path + '.tmp', path)
+        os.remove(pending[0])
+
+def start_worker(queue_dir, evaluate, modules, eval_args, device):
+    ''' Launch run_worker in a separate process. The worker gets its own
+    CPU copy of `modules`, so the training weights are never shared '''
+    if not os.path.exists(queue_dir):
+        os.makedirs(queue_dir)
+    if os.path.exists(os.path.join(queue_dir, STOP)):
+        os.remove(os.path.join(queue_dir, STOP))
+    ''' Results of an earlier run would otherwise be drained as this one's '''
+    for path in glob.glob(os.path.join(queue_dir, 'epoch*_metrics.json')):
+        os.remove(path)
+
+    modules = {name: None if m is None else copy.deepcopy(m).cpu()\
+            for name, m in modules.items()}
+    worker = mp.get_context('spawn').Process(target=run_worker,\
+            args=(queue_dir, evaluate, modules, eval_args, device))
+    worker.start()
+    return worker
+
+def finish_worker(queue_dir, worker):
+    ''' Let the worker drain the queue, then wait for it '''
+    open(os.path.join(queue_dir, STOP), 'w').close()
+    worker.join()
@@ -0,0 +1,58 @@
+import torch
+import numpy as np
+import argparse
+import time
+from utils import shuffle_rows
+
+SCALES = {
+    'FB15k-237': (272115, 14541, 237),
+    'ML-1M': (900188, 9746, 5),
+}
+
+def host_roundtrip(data, device):
+    if torch.is_tensor(data):
+        data = data.cpu().numpy()
+    np.random.shuffle(data)
+    data = torch.LongTensor(np.ascontiguousarray(data))
+    return data.to(device).contiguous()
+
+def synthetic(num_rows, num_ent, num_rel, seed=0):
+    rs = np.random.RandomState(seed)
+    return np.stack([rs.randint(num_ent, size=num_rows),\
+            rs.randint(num_rel, size=num_rows),\
+            rs.randint(num_ent, size=num_rows)], axis=1).astype(np.int64)
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def time_epochs(fn, data, device, epochs):
+    data = fn(data)
+    sync(device)
+    start = time.time()
+    for _ in range(epochs):
+        data = fn(data)
+    sync(device)
+    return (time.time() - start) / epochs
+
+def main(args):
+    ''' Per-epoch cost of shuffling a training split: the old host round trip
+    (device -> numpy shuffle -> LongTensor -> device) against shuffle_rows,
+    which only permutes an index on the device the rows already live on.
+    Triplets are synthetic, sized like the real splits '''
+    device = torch.device(args.device)
+    for name, (num_rows, num_ent, num_rel) in SCALES.items():
+        rows = synthetic(num_rows, num_ent, num_rel)
+        on_device = torch.from_numpy(rows).to(device)
+        old = time_epochs(lambda d: host_roundtrip(d, device), on_device.clone(),\
+                device, args.epochs)
+        new = time_epochs(shuffle_rows, on_device.clone(), device, args.epochs)
+        print("%-10s %8d rows on %s: host round trip %8.2f ms/epoch, "\
+                "randperm %8.2f ms/epoch (%.1fx)" % (name, num_rows, device,\
+                old * 1e3, new * 1e3, old / new))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device the prefetched split lives on (default: cuda if available)')
+    parser.add_argument('--epochs', type=int, default=20, help='Timed shuffles per scale (default: 20)')
+    main(parser.parse_args())
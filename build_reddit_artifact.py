@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+from utils import load_reddit_graph, reddit_mappings, encode_reddit_edges,\
+        RedditGraph, REDDIT_ARTIFACT_VERSION
+from create_reddit_graph import sorted_vocab
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--graph', type=str, default='./reddit_data/'\
+            'Reddit_split_2017-11/split_csv/10_master_G_k_core_edges.npz',\
+            help='k-core .npz from create_reddit_graph, or its gpickle')
+    parser.add_argument('--out_dir', type=str, default='./reddit_data/'\
+            'Reddit_split_2017-11/split_csv/10_reddit_artifact_v%d' %\
+            REDDIT_ARTIFACT_VERSION, help='Artifact directory main_reddit '\
+            'memory-maps with --artifact')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0],\
+            help='Seeds to write train/test splits for (default: 0)')
+    parser.add_argument('--cutoff', type=float, default=0.9,\
+            help='Train fraction of edges and users (default: 0.9)')
+    args = parser.parse_args()
+    return args
+
+def graph_arrays(G):
+    ''' (E, 2) int64 [user, sr] edges and both vocabularies of a RedditGraph
+    or a networkx graph, with the vocabularies sorted '''
+    if isinstance(G, RedditGraph):
+        edges, users, subreddits = G.edge_array, G.users, G.subreddits
+    else:
+        u_to_idx, sr_to_idx = reddit_mappings(list(G.nodes()))
+        edges = encode_reddit_edges(list(G.edges()), u_to_idx, sr_to_idx)
+        users, subreddits = list(u_to_idx), list(sr_to_idx)
+    users, user_rank = sorted_vocab(users)
+    subreddits, sr_rank = sorted_vocab(subreddits)
+    edges = np.stack([user_rank[edges[:, 0]], sr_rank[edges[:, 1]]], axis=1)
+    return edges, users.astype(str), subreddits.astype(str)
+
+def degree_order(user_degree, sr_degree):
+    ''' Subreddits sorted by degree, with the rank each one has among all
+    nodes in the stable descending sort main_reddit did over G.degree '''
+    degrees = np.concatenate([user_degree, sr_degree])
+    rank = np.empty(len(degrees), dtype=np.int64)
+    rank[np.argsort(-degrees, kind='stable')] = np.arange(len(degrees))
+    sr_rank = rank[len(user_degree):]
+    sr_by_degree = np.argsort(sr_rank, kind='stable')
+    return sr_by_degree, sr_rank[sr_by_degree]
+
+def membership(edges, num_sr):
+    ''' Users of every subreddit as CSR: sr_users[sr_ptr[i]:sr_ptr[i + 1]] '''
+    order = np.argsort(edges[:, 1], kind='stable')
+    sr_ptr = np.zeros(num_sr + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges[:, 1], minlength=num_sr), out=sr_ptr[1:])
+    return sr_ptr, np.ascontiguousarray(edges[order, 0])
+
+def splits(edges, num_users, seed, cutoff):
+    ''' Seeded train/test rows of edges and ids of users '''
+    rs = np.random.RandomState(seed)
+    edge_perm = rs.permutation(len(edges))
+    user_perm = rs.permutation(num_users)
+    edge_cut = int(np.round(len(edges) * cutoff))
+    user_cut = int(np.round(num_users * cutoff))
+    return {'train_edges_seed%d' % seed: edges[edge_perm[:edge_cut]],
+            'test_edges_seed%d' % seed: edges[edge_perm[edge_cut:]],
+            'train_users_seed%d' % seed: user_perm[:user_cut].astype(np.int64),
+            'test_users_seed%d' % seed: user_perm[user_cut:].astype(np.int64)}
+
+def build(graph_fn, out_dir, seeds, cutoff=0.9):
+    ''' Do the preprocessing main_reddit used to redo on every start once,
+    and write its results as .npy files plus a manifest. Arrays are written
+    to out_dir + '.tmp', which replaces out_dir once complete '''
+    edges, users, subreddits = graph_arrays(load_reddit_graph(graph_fn))
+    user_degree = np.bincount(edges[:, 0], minlength=len(users))
+    sr_degree = np.bincount(edges[:, 1], minlength=len(subreddits))
+    sr_by_degree, sr_node_rank = degree_order(user_degree, sr_degree)
+    sr_ptr, sr_users = membership(edges, len(subreddits))
+    arrays = {'edges': edges, 'users': users, 'subreddits': subreddits,
+            'sr_degree': sr_degree, 'sr_by_degree': sr_by_degree,
+            'sr_node_rank': sr_node_rank, 'sr_ptr': sr_ptr, 'sr_users': sr_users}
+    for seed in seeds:
+        arrays.update(splits(edges, len(users), seed, cutoff))
+
+    tmp_dir = out_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    manifest = {'version': REDDIT_ARTIFACT_VERSION, 'source': graph_fn,
+            'num_edges': len(edges), 'num_users': len(users),
+            'num_sr': len(subreddits), 'seeds': list(seeds), 'cutoff': cutoff}
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    return manifest
+
+def main(args):
+    manifest = build(args.graph, args.out_dir, args.seeds, args.cutoff)
+    print("Wrote %s: %d edges, %d users, %d subreddits, seeds %s" %\
+            (args.out_dir, manifest['num_edges'], manifest['num_users'],\
+            manifest['num_sr'], manifest['seeds']))
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -8,6 +8,7 @@ import subprocess
 from tqdm import tqdm
 import concurrent.futures
 import pandas as pd
+import numpy as np
 import networkx as nx
 import glob
 
@@ -24,6 +25,13 @@ def parse_args():
             default='master_G_graph.pkl', help="output path")
     parser.add_argument('--save_master_k_core', type=str,\
             default='master_G_k_core_graph.pkl', help="output path")
+    parser.add_argument('--save_k_core_edges', type=str,\
+            default='master_G_k_core_edges.npz', help="output path of the array builder")
+    parser.add_argument('--num_workers', type=int, default=None,\
+            help='Processes encoding split files (default: one per core)')
+    parser.add_argument('--builder', type=str, default='arrays',\
+            choices=['arrays', 'networkx'], help='Build the k-core from int64 '\
+            'edge arrays, or through networkx graphs (default: arrays)')
     args = parser.parse_args()
     return args
 
@@ -45,9 +53,122 @@ def process_csv(filename):
     nx.write_gpickle(G,save_path)
     return G
 
+def read_split(filename):
+    ''' Prefixed (user, subreddit) name columns of one split csv, as object
+    arrays of python strings '''
+    reddit_dump = pd.read_csv(filename, encoding='utf-8',\
+            usecols=['users', 'subreddit'], dtype=str).dropna()
+    users = ("U_" + reddit_dump['users']).values
+    subreddit = ("SR_" + reddit_dump['subreddit']).values
+    return users, subreddit
+
+def dedupe_edges(user_ids, sr_ids, num_sr):
+    ''' Sorted unique (E, 2) int64 [user, sr] rows, deduplicated as packed
+    user * num_sr + sr keys '''
+    keys = np.unique(user_ids.astype(np.int64) * num_sr + sr_ids)
+    return np.stack([keys // num_sr, keys % num_sr], axis=1)
+
+def encode_split(filename):
+    ''' Map stage: one split hashed into local ids with pd.factorize, with
+    locally deduplicated edges. The local vocabularies go back to the
+    parent as object arrays, so they pickle as variable-length strings
+    rather than fixed-width UTF-32 padded to the longest name '''
+    users, subreddit = read_split(filename)
+    user_ids, user_vocab = pd.factorize(users)
+    sr_ids, sr_vocab = pd.factorize(subreddit)
+    return dedupe_edges(user_ids, sr_ids, len(sr_vocab)),\
+            np.asarray(user_vocab, dtype=object), np.asarray(sr_vocab, dtype=object)
+
+def merge_vocab(index, names):
+    ''' Global ids of a split's local vocabulary `names`. Unseen names are
+    appended to the name -> id dict `index`, so vocabularies are merged
+    incrementally as splits arrive '''
+    return np.fromiter((index.setdefault(name, len(index)) for name in names),\
+            dtype=np.int64, count=len(names))
+
+def sorted_vocab(index):
+    ''' Names of `index` sorted, and the sorted position of every id '''
+    names = np.array(list(index), dtype=object)
+    order = np.argsort(names, kind='stable')
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[order] = np.arange(len(names))
+    return names[order], rank
+
+def build_edges(split_files, num_workers=None):
+    ''' Encode every split in a process pool and, as each one finishes,
+    merge its vocabularies into the global ones and remap its edges. The
+    result has sorted vocabularies per node type and globally
+    deduplicated edges '''
+    users, srs = {}, {}
+    user_ids, sr_ids = [], []
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(encode_split, f) for f in split_files]
+        for future in tqdm(concurrent.futures.as_completed(futures),\
+                total=len(futures)):
+            edges, user_vocab, sr_vocab = future.result()
+            user_ids.append(merge_vocab(users, user_vocab)[edges[:, 0]])
+            sr_ids.append(merge_vocab(srs, sr_vocab)[edges[:, 1]])
+    user_vocab, user_rank = sorted_vocab(users)
+    sr_vocab, sr_rank = sorted_vocab(srs)
+    edges = dedupe_edges(user_rank[np.concatenate(user_ids)],\
+            sr_rank[np.concatenate(sr_ids)], len(sr_vocab))
+    return edges, user_vocab, sr_vocab
+
+def bipartite_csr(edges, num_users, num_sr):
+    ''' Undirected CSR adjacency over users [0, num_users) followed by
+    subreddits [num_users, num_users + num_sr) '''
+    src = np.concatenate([edges[:, 0], edges[:, 1] + num_users])
+    dst = np.concatenate([edges[:, 1] + num_users, edges[:, 0]])
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(num_users + num_sr + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=num_users + num_sr), out=indptr[1:])
+    return indptr, dst[order]
+
+def k_core_mask(edges, num_users, num_sr, k):
+    ''' Edges of the k-core, as nx.k_core keeps them, by peeling every
+    node of degree < k at once per round. Peeled nodes only decrement the
+    degrees of their CSR neighbours, so a round costs their adjacency '''
+    num_nodes = num_users + num_sr
+    indptr, indices = bipartite_csr(edges, num_users, num_sr)
+    degree = np.diff(indptr)
+    alive = np.ones(num_nodes, dtype=bool)
+    peel = np.nonzero(degree < k)[0]
+    while len(peel):
+        alive[peel] = False
+        starts, counts = indptr[peel], indptr[peel + 1] - indptr[peel]
+        offsets = np.cumsum(counts) - counts
+        idx = np.arange(counts.sum()) - np.repeat(offsets, counts) + np.repeat(starts, counts)
+        degree -= np.bincount(indices[idx], minlength=num_nodes)
+        peel = np.nonzero(alive & (degree < k))[0]
+    return alive[edges[:, 0]] & alive[edges[:, 1] + num_users]
+
+def save_k_core_edges(path, edges, user_vocab, sr_vocab):
+    ''' Keep the k-core edges and the nodes they touch, re-indexed densely,
+    in the npz that utils.load_reddit_graph reads. Edges are stored sorted
+    user-major, so consumers must permute them before splitting '''
+    users, user_ids = np.unique(edges[:, 0], return_inverse=True)
+    srs, sr_ids = np.unique(edges[:, 1], return_inverse=True)
+    np.savez(path, edges=np.stack([user_ids, sr_ids], axis=1).astype(np.int64),\
+            users=user_vocab[users].astype(str), subreddits=sr_vocab[srs].astype(str))
+
+def build_k_core_arrays(args, split_files, save_path_base):
+    edges, user_vocab, sr_vocab = build_edges(split_files, args.num_workers)
+    print("Created Master Edges: %d edges, %d users, %d subreddits" %\
+            (len(edges), len(user_vocab), len(sr_vocab)))
+    keep = k_core_mask(edges, len(user_vocab), len(sr_vocab), args.k_core)
+    print("K-core of Master Graph: %d edges" % keep.sum())
+    save_path_k_core = save_path_base + str(args.k_core) + \
+            '_' + args.save_k_core_edges
+    save_k_core_edges(save_path_k_core, edges[keep], user_vocab, sr_vocab)
+
 def main(args):
     save_path_base = "./reddit_data/Reddit_split_2017-11/split_csv/"
     save_path_master = save_path_base + args.save_master
+    if args.builder == 'arrays':
+        split_files = [f for f in glob.glob(args.filedir + args.fileprefix)\
+                if f.endswith('.csv')]
+        build_k_core_arrays(args, split_files, save_path_base)
+        return
     ipdb.set_trace()
     if  os.path.isfile(save_path_master):
         master_G = nx.read_gpickle(save_path_master)
@@ -0,0 +1,223 @@
+import torch
+import torch.multiprocessing as mp
+import atexit
+import copy
+import torch.nn as nn
+import numpy as np
+from tqdm import tqdm
+from utils import count_better, rank_from_counts
+
+ltensor = torch.LongTensor
+
+def chunk_size_for(modelD, batch_size, mem_budget):
+    ''' Candidates per chunk so that one (batch_size, chunk, embed_dim)
+    sweep step stays within `mem_budget` megabytes '''
+    # candidate embeddings, their difference to the query and the energies
+    per_cand = batch_size * (2 * modelD.embed_dim + 1) * 4
+    return max(1, min(modelD.num_ent, int(mem_budget * 2**20 // per_cand)))
+
+def sweep_ranks(batch, queries, side, modelD, all_known, chunk_size,\
+        filters=None, ties='optimistic'):
+    ''' Filtered ranks of column `side` of `batch`, sweeping the entity
+    table chunk_size candidates at a time and only keeping per-query
+    counts of better and tied candidates '''
+    device = batch.device
+    targets = batch[:, side]
+    rows = torch.arange(len(batch), device=device)
+    ''' One energy per row from the forward pass; TransE takes no filters '''
+    if filters is None:
+        enrg = modelD(batch).view(-1, 1)
+    else:
+        enrg = modelD(batch, filters=filters).view(-1, 1)
+
+    spans = all_known.known_spans(queries, side, device=device)
+    n_better = torch.zeros(len(batch), dtype=torch.long, device=device)
+    n_equal = torch.zeros(len(batch), dtype=torch.long, device=device)
+    for start in range(0, modelD.num_ent, chunk_size):
+        stop = min(start + chunk_size, modelD.num_ent)
+        ents = torch.arange(start, stop, dtype=torch.long, device=device)
+        enrgs = modelD.score_candidates(batch, side, filters=filters, ents=ents)
+        fns = all_known.filter_mask(queries, side, device=device,\
+                start=start, stop=stop, spans=spans)
+        own = (targets >= start) & (targets < stop)
+        fns[rows[own], targets[own] - start] = True
+        better, equal = count_better(enrgs, enrg, fns)
+        n_better += better
+        n_equal += equal
+
+    return rank_from_counts(n_better, n_equal, ties)
+
+_worker = {}
+_pool = {}
+
+def _init_worker(all_known):
+    torch.set_num_threads(1)
+    _worker.update(all_known=all_known)
+
+def _rank_shard(task):
+    triplets, modelD, filters, kwargs = task
+    return rank_triplets(triplets, modelD, _worker['all_known'],\
+            filters=filters, **kwargs)
+
+def _shared_copy(module):
+    ''' Detached CPU copy of `module` in shared memory, so the live model
+    keeps its own storage. max_norm embeddings are renormalized up front,
+    since lookups renormalize in place and workers must only read the
+    shared tables. A projection cache is left out: it is keyed by the
+    live filters, which never match the workers' copies '''
+    cache = getattr(module, 'proj_cache', None)
+    memo = {} if cache is None else {id(cache): None}
+    module = copy.deepcopy(module, memo).cpu()
+    with torch.no_grad():
+        for m in module.modules():
+            if isinstance(m, nn.Embedding) and m.max_norm is not None:
+                m(torch.arange(m.num_embeddings))
+    return module.share_memory()
+
+def _get_pool(num_workers, all_known):
+    ''' One spawn pool per run, started on first use and reused by every
+    later validation over the same known-triple index '''
+    key = (num_workers, id(all_known))
+    if key not in _pool:
+        close_pool()
+        if all_known.shared is None:
+            all_known.share_memory()
+        ctx = mp.get_context('spawn')
+        _pool[key] = ctx.Pool(num_workers, initializer=_init_worker,\
+                initargs=(all_known,))
+    return _pool[key]
+
+def close_pool():
+    ''' Shut down the ranking pool, if one was started '''
+    for pool in _pool.values():
+        pool.close()
+        pool.join()
+    _pool.clear()
+
+atexit.register(close_pool)
+
+def rank_sharded(triplets, modelD, all_known, num_workers, filters=None, **kwargs):
+    ''' rank_triplets over contiguous shards of `triplets` in a persistent
+    pool of CPU processes. The known-triple index reaches the workers once,
+    when the pool starts; each call hands them shared-memory copies of the
+    current model and filters, and shard ranks are concatenated back in
+    order '''
+    modelD = _shared_copy(modelD)
+    if filters is not None:
+        filters = [None if f is None else _shared_copy(f) for f in filters]
+
+    kwargs.update(show_tqdm=False)
+    shards = [s for s in np.array_split(triplets, num_workers * 4) if len(s)]
+    pool = _get_pool(num_workers, all_known)
+    ranks = pool.map(_rank_shard, [(s, modelD, filters, kwargs) for s in shards])
+
+    l_ranks = np.concatenate([l for l, _ in ranks])
+    r_ranks = np.concatenate([r for _, r in ranks])
+    return l_ranks, r_ranks
+
+def rank_triplets(triplets, modelD, all_known, batch_size=64,\
+        filters=None, use_cuda=False, show_tqdm=False, ties='optimistic',\
+        mem_budget=512, num_workers=1):
+    ''' Filtered lhs/rhs ranks of `triplets`. The entity table is swept in
+    chunks sized to `mem_budget` megabytes, so peak memory does not grow
+    with num_ent. Masking and ranking stay on the model's device; only the
+    ranks are copied back. On CPU, num_workers > 1 shards the work across
+    processes '''
+    if torch.is_tensor(triplets):
+        triplets = triplets.cpu().numpy()
+    triplets = np.ascontiguousarray(triplets, dtype=np.int64)
+    if num_workers > 1 and not use_cuda:
+        return rank_sharded(triplets, modelD, all_known, num_workers,\
+                filters=filters, batch_size=batch_size, ties=ties,\
+                mem_budget=mem_budget)
+
+    chunk_size = chunk_size_for(modelD, batch_size, mem_budget)
+
+    starts = range(0, len(triplets), batch_size)
+    if show_tqdm:
+        starts = tqdm(starts)
+
+    l_ranks, r_ranks = [], []
+    with torch.no_grad():
+        for start in starts:
+            queries = triplets[start:start+batch_size]
+            batch = ltensor(queries)
+            if use_cuda:
+                batch = batch.cuda()
+
+            l_ranks.append(sweep_ranks(batch, queries, 0, modelD, all_known,\
+                    chunk_size, filters=filters, ties=ties))
+            r_ranks.append(sweep_ranks(batch, queries, 2, modelD, all_known,\
+                    chunk_size, filters=filters, ties=ties))
+
+    l_ranks = torch.cat(l_ranks).cpu().numpy()
+    r_ranks = torch.cat(r_ranks).cpu().numpy()
+
+    return l_ranks, r_ranks
+
+def _interval(values, z):
+    ''' Mean and normal-approximation half-width of a per-triplet metric '''
+    if len(values) < 2:
+        return values.mean(), float('inf')
+    return values.mean(), z * values.std(ddof=1) / np.sqrt(len(values))
+
+def sequential_ranks(triplets, modelD, all_known, tol, best_mrr=None, seed=0,\
+        block_size=512, min_triplets=1000, z=1.96, **kwargs):
+    ''' Rank `triplets` in a seeded random order, block by block, until the
+    confidence interval of MRR is narrower than `tol` or lies entirely on
+    one side of `best_mrr`. Returns the ranks seen so far and a summary
+    with MR, MRR and Hits@k estimates and their half-widths '''
+    if torch.is_tensor(triplets):
+        triplets = triplets.cpu().numpy()
+    order = np.random.RandomState(seed).permutation(len(triplets))
+
+    l_ranks, r_ranks = np.zeros(0), np.zeros(0)
+    reason = 'exhausted'
+    for start in range(0, len(order), block_size):
+        l, r = rank_triplets(triplets[order[start:start+block_size]], modelD,\
+                all_known, **kwargs)
+        l_ranks = np.concatenate([l_ranks, l])
+        r_ranks = np.concatenate([r_ranks, r])
+        if len(l_ranks) < min_triplets:
+            continue
+
+        mrr, half = _interval((1. / l_ranks + 1. / r_ranks) / 2, z)
+        if 2 * half < tol:
+            reason = 'converged'
+            break
+        if best_mrr is not None and mrr + half < best_mrr:
+            reason = 'worse than best'
+            break
+        if best_mrr is not None and mrr - half > best_mrr:
+            reason = 'better than best'
+            break
+
+    summary = {'num_triplets': len(l_ranks), 'stop': reason}
+    summary['mr'] = _interval((l_ranks + r_ranks) / 2, z)
+    summary['mrr'] = _interval((1. / l_ranks + 1. / r_ranks) / 2, z)
+    for k in (5, 10):
+        summary['h%d' % k] = _interval(((l_ranks <= k) + (r_ranks <= k)) / 2., z)
+    return l_ranks, r_ranks, summary
+
+def test_sequential(dataset, args, all_known, modelD, filter_set, experiment, best_mrr=None):
+    ''' Sequential validation of the trainers (--valid_tol > 0): ranks
+    `dataset` through sequential_ranks with projections cached, prints
+    and logs MR, MRR and Hits@k with their half-widths '''
+    modelD.cache_projections(args.proj_cache_mb, filters=filter_set)
+    try:
+        l_ranks, r_ranks, summary = sequential_ranks(dataset.dataset, modelD,\
+                all_known, args.valid_tol, best_mrr=best_mrr, seed=args.valid_seed,\
+                batch_size=args.eval_batch_size, filters=filter_set,\
+                use_cuda=args.use_cuda, ties=args.rank_ties, mem_budget=args.eval_mem_mb)
+    finally:
+        modelD.cache_projections(0)
+
+    names = [('mr', 'MR'), ('mrr', 'MRR'), ('h5', 'Hits@5'), ('h10', 'Hits@10')]
+    print("Validated on %d triplets (%s): %s" %(summary['num_triplets'], summary['stop'],\
+            ', '.join("%s %f +- %f" %(name, summary[key][0], summary[key][1])\
+            for key, name in names)))
+    if args.do_log:
+        experiment.log_metric("Validation Triplets", summary['num_triplets'])
+        for key, name in names:
+            experiment.log_metric("Validation %s Interval" % name, float(summary[key][1]))
+    return l_ranks, r_ranks
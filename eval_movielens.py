@@ -27,6 +27,7 @@ import subprocess
 from tqdm import tqdm
 tqdm.monitor_interval = 0
 from utils import *
+from eval_kb import rank_triplets
 from preprocess_movie_lens import make_dataset
 import joblib
 from collections import Counter
@@ -75,14 +76,14 @@ def multiclass_roc_auc_score(y_test, y_pred, average="micro"):
 
 def test_dummy(args,test_dataset,modelD,net,dummy,experiment,\
         epoch,strategy,multi_class=False,filter_set=None):
-    test_loader = DataLoader(test_dataset, num_workers=1, batch_size=604)
+    test_loader = BatchLoader(test_dataset, 604, shuffle=False)
     correct = 0
     preds_list, probs_list, labels_list = [], [],[]
     sensitive_attr = net.users_sensitive
     for p_batch in test_loader:
         p_batch_var = Variable(p_batch).cuda()
         p_batch_emb = modelD.encode(p_batch_var.detach(),filter_set)
-        y = sensitive_attr[p_batch]
+        y = sensitive_attr[p_batch.cpu()]
         preds = dummy.predict(p_batch_emb)
         acc = 100.* accuracy_score(y,preds)
         preds_list.append(preds)
@@ -104,7 +105,7 @@ def test_dummy(args,test_dataset,modelD,net,dummy,experiment,\
 
 def test_random(args,test_dataset,modelD,net,experiment,\
         epoch,filter_set=None):
-    test_loader = DataLoader(test_dataset, num_workers=1, batch_size=512)
+    test_loader = BatchLoader(test_dataset, 512, shuffle=False)
     correct = 0
     preds_list, probs_list, labels_list = [], [],[]
     for p_batch in test_loader:
@@ -127,6 +128,7 @@ def test_random(args,test_dataset,modelD,net,experiment,\
         experiment.log_metric("Test"+net.attribute+" AUC",float(AUC),step=epoch)
         experiment.log_metric("Test "+net.attribute+" Accuracy",float(acc),step=epoch)
         experiment.log_metric("Test "+net.attribute+" F1",float(f1),step=epoch)
+    return acc, AUC, f1
 
 def train_random(args,modelD,train_dataset,test_dataset,\
         attr_data,experiment,filter_set=None):
@@ -134,7 +136,7 @@ def train_random(args,modelD,train_dataset,test_dataset,\
     net = RandomDiscriminator(args.use_1M,args.embed_dim,attr_data,\
             'random',use_cross_entropy=args.use_cross_entropy).to(args.device)
     opt = optimizer(net.parameters(),'adam', args.lr)
-    train_loader = DataLoader(train_dataset, num_workers=1, batch_size=3000)
+    train_loader = BatchLoader(train_dataset, 3000, shuffle=False)
     train_data_itr = enumerate(train_loader)
     criterion = nn.BCELoss()
 
@@ -166,7 +168,7 @@ def train_random(args,modelD,train_dataset,test_dataset,\
 
 def test_gender(args,test_dataset,modelD,net,experiment,\
         epoch,filter_set=None):
-    test_loader = DataLoader(test_dataset, num_workers=1, batch_size=512)
+    test_loader = BatchLoader(test_dataset, 512, shuffle=False)
     correct = 0
     preds_list, probs_list, labels_list  = [], [], []
     for p_batch in test_loader:
@@ -189,6 +191,7 @@ def test_gender(args,test_dataset,modelD,net,experiment,\
         experiment.log_metric("Test"+net.attribute+" AUC",float(AUC),step=epoch)
         experiment.log_metric("Test "+net.attribute+" Accuracy",float(acc),step=epoch)
         experiment.log_metric("Test "+net.attribute+" F1",float(f1),step=epoch)
+    return acc, AUC, f1
 
 def train_gender(args,modelD,train_dataset,test_dataset,\
         attr_data,experiment,filter_set=None):
@@ -196,7 +199,7 @@ def train_gender(args,modelD,train_dataset,test_dataset,\
     net = GenderDiscriminator(args.use_1M,args.embed_dim,attr_data,\
             'gender',use_cross_entropy=args.use_cross_entropy).to(args.device)
     opt = optimizer(net.parameters(),'adam', args.lr)
-    train_loader = DataLoader(train_dataset, num_workers=1, batch_size=3000)
+    train_loader = BatchLoader(train_dataset, 3000, shuffle=False)
     train_data_itr = enumerate(train_loader)
     criterion = nn.BCELoss()
 
@@ -240,7 +243,7 @@ def train_gender(args,modelD,train_dataset,test_dataset,\
 
 def test_age(args,test_dataset,modelD,net,experiment,\
         epoch,filter_set=None):
-    test_loader = DataLoader(test_dataset, num_workers=1, batch_size=512)
+    test_loader = BatchLoader(test_dataset, 512, shuffle=False)
     correct = 0
     preds_list, labels_list, probs_list = [], [],[]
     for p_batch in test_loader:
@@ -263,6 +266,7 @@ def test_age(args,test_dataset,modelD,net,experiment,\
         experiment.log_metric("Test"+net.attribute+"AUC",float(AUC),step=epoch)
         experiment.log_metric("Test "+net.attribute+" Accuracy",float(acc),step=epoch)
         experiment.log_metric("Test "+net.attribute+" F1",float(f1),step=epoch)
+    return acc, AUC, f1
 
 def train_age(args,modelD,train_dataset,test_dataset,attr_data,\
         experiment,filter_set=None):
@@ -270,7 +274,7 @@ def train_age(args,modelD,train_dataset,test_dataset,attr_data,\
     net = AgeDiscriminator(args.use_1M,args.embed_dim,attr_data,\
             'age',use_cross_entropy=args.use_cross_entropy).to(args.device)
     opt = optimizer(net.parameters(),'adam', args.lr)
-    train_loader = DataLoader(train_dataset, num_workers=1, batch_size=3000)
+    train_loader = BatchLoader(train_dataset, 3000, shuffle=False)
     train_data_itr = enumerate(train_loader)
     criterion = nn.NLLLoss()
 
@@ -310,7 +314,7 @@ def train_age(args,modelD,train_dataset,test_dataset,attr_data,\
                 epoch,strategy,True,filter_set)
 
 def test_occupation(args,test_dataset,modelD,net,experiment,epoch,filter_set=None):
-    test_loader = DataLoader(test_dataset, num_workers=1, batch_size=8000)
+    test_loader = BatchLoader(test_dataset, 8000, shuffle=False)
     correct = 0
     preds_list, labels_list, probs_list = [], [],[]
     for p_batch in test_loader:
@@ -334,6 +338,7 @@ def test_occupation(args,test_dataset,modelD,net,experiment,epoch,filter_set=Non
             experiment.log_metric("Test"+net.attribute+" AUC",float(AUC),step=epoch)
             experiment.log_metric("Test "+net.attribute+" Accuracy",float(acc),step=epoch)
             experiment.log_metric("Test "+net.attribute+" F1",float(f1),step=epoch)
+        return acc, AUC, f1
     except:
         acc = 100. * correct / len(test_dataset)
         print("Test Occupation Accuracy is: %f" %(acc))
@@ -341,6 +346,7 @@ def test_occupation(args,test_dataset,modelD,net,experiment,epoch,filter_set=Non
             experiment.log_metric("Test"+net.attribute+" Accuracy",float(acc),step=epoch)
             experiment.log_metric("Test "+net.attribute+" Accuracy",float(acc),step=epoch)
             experiment.log_metric("Test "+net.attribute+" F1",float(acc),step=epoch)
+        return acc, None, None
 
 def train_occupation(args,modelD,train_dataset,test_dataset,\
         attr_data,experiment,filter_set=None):
@@ -348,7 +354,7 @@ def train_occupation(args,modelD,train_dataset,test_dataset,\
     net = OccupationDiscriminator(args.use_1M,args.embed_dim,attr_data,\
             'occupation',use_cross_entropy=args.use_cross_entropy).to(args.device)
     opt = optimizer(net.parameters(),'adam', args.lr)
-    train_loader = DataLoader(train_dataset, num_workers=1, batch_size=8000)
+    train_loader = BatchLoader(train_dataset, 8000, shuffle=False)
     train_data_itr = enumerate(train_loader)
     criterion = nn.NLLLoss()
 
@@ -460,51 +466,14 @@ def calc_attribute_bias(mode,args,modelD,experiment,\
         experiment.log_metric(mode +" " + attribute + "Bias",float(avg_bias))
     return avg_bias
 
-def test(dataset, args, all_hash, modelD, subsample=1):
-    l_ranks, r_ranks = [], []
-    test_loader = DataLoader(dataset, num_workers=1, collate_fn=collate_fn)
+def test(dataset, args, all_known, modelD, subsample=1):
+    triplets = dataset.dataset[::subsample]
+    l_ranks, r_ranks = rank_triplets(triplets, modelD, all_known,\
+            batch_size=args.eval_batch_size, use_cuda=args.use_cuda,\
+            show_tqdm=args.show_tqdm, ties=args.rank_ties,\
+            mem_budget=args.eval_mem_mb,\
+            num_workers=args.eval_workers)
 
-    cst_inds = np.arange(args.num_ent, dtype=np.int64)[:,None]
-    if args.show_tqdm:
-        data_itr = tqdm(enumerate(test_loader))
-    else:
-        data_itr = enumerate(test_loader)
-
-    for idx, triplet in data_itr:
-        if idx % subsample != 0:
-            continue
-
-        lhs, rel, rhs = triplet.view(-1)
-
-        l_batch = np.concatenate([cst_inds, np.array([[rel, rhs]]).repeat(args.num_ent, axis=0)], axis=1)
-        r_batch = np.concatenate([np.array([[lhs, rel]]).repeat(args.num_ent, axis=0), cst_inds], axis=1)
-
-        l_fns = np.array([int(x.tobytes() in all_hash) for x in l_batch], dtype=np.float32)
-        r_fns = np.array([int(x.tobytes() in all_hash) for x in r_batch], dtype=np.float32)
-
-        l_batch = ltensor(l_batch).contiguous()
-        r_batch = ltensor(r_batch).contiguous()
-
-        if args.use_cuda:
-            l_batch = l_batch.cuda()
-            r_batch = r_batch.cuda()
-
-        l_batch = Variable(l_batch)
-        r_batch = Variable(r_batch)
-
-        d_ins = torch.cat([l_batch, r_batch], dim=0)
-        d_outs = modelD(d_ins)
-        l_enrgs = d_outs[:len(l_batch)]
-        r_enrgs = d_outs[len(l_batch):]
-
-        l_rank = compute_rank(v2np(l_enrgs), lhs, mask_observed=l_fns)
-        r_rank = compute_rank(v2np(r_enrgs), rhs, mask_observed=r_fns)
-
-        l_ranks.append(l_rank)
-        r_ranks.append(r_rank)
-
-    l_ranks = np.array(l_ranks)
-    r_ranks = np.array(r_ranks)
     l_mean = l_ranks.mean()
     r_mean = r_ranks.mean()
     l_mrr = (1. / l_ranks).mean()
@@ -577,11 +546,12 @@ def test_nce(dataset, args, modelD, epoch, experiment):
         experiment.log_metric("Test Model RMSE",float(rms),step=epoch)
         experiment.log_metric("Test Model AUC",float(AUC),step=epoch)
         experiment.log_metric("Test Model Accuracy",float(acc),step=epoch)
+    return acc, AUC, float(rms)
 
 def train_fairness_classifier_gcmc(train_dataset,args,modelD,experiment,fairD,\
         fair_optim,epoch,filter_=None,retrain=False,log_freq=2):
 
-    train_loader = DataLoader(train_dataset, num_workers=1, batch_size=8000)#, collate_fn=collate_fn)
+    train_loader = BatchLoader(train_dataset, 8000, shuffle=False)#, collate_fn=collate_fn)
     correct = 0
     total_ent = 0
     gender_correct,occupation_correct,age_correct,random_correct = 0,0,0,0
@@ -686,7 +656,7 @@ def train_fairness_classifier(dataset,args,modelD,experiment,fairD,\
 def test_fairness_gcmc(test_dataset,args,modelD,experiment,fairD,\
         attribute,epoch,filter_=None,retrain=False):
 
-    test_loader = DataLoader(test_dataset, num_workers=1, batch_size=8000)#, collate_fn=collate_fn)
+    test_loader = BatchLoader(test_dataset, 8000, shuffle=False)#, collate_fn=collate_fn)
     correct = 0
     total_ent = 0
     precision_list = []
@@ -257,8 +257,7 @@ def test_reddit_nce(dataset, epoch, test_hash, args, modelD, experiment,\
         p_batch_var = Variable(p_batch).cuda()
         nce_batch_var = Variable(nce_batch).cuda()
         if args.filter_false_negs:
-            nce_falseNs = torch.FloatTensor(np.array([int(x.tobytes() in test_hash)\
-                    for x in nce_batch.numpy()], dtype=np.float32))
+            nce_falseNs = test_hash.contains(nce_batch).float()
         p_enrgs = modelD(p_batch_var,filters=filters_set)
         nce_enrgs = modelD(nce_batch_var,filters=filters_set)
         ''' Artificially create labels for both classes '''
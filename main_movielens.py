@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import shutil
+import copy
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils.data import Dataset, DataLoader
@@ -28,6 +29,8 @@ import ipdb
 sys.path.append('../')
 import gc
 from model import *
+from async_eval import submit_checkpoint, start_worker, finish_worker,\
+        drain_metrics, log_metrics
 
 # ftensor = torch.FloatTensor
 ltensor = torch.LongTensor
@@ -57,13 +60,20 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, default=8192, help='Batch size (default: 512)')
     parser.add_argument('--dropout_p', type=float, default=0.2, help='Batch size (default: 512)')
     parser.add_argument('--gamma', type=int, default=1, help='Tradeoff for Adversarial Penalty')
+    parser.add_argument('--eval_batch_size', type=int, default=64, help='Test triplets ranked per forward pass (default: 64)')
+    parser.add_argument('--rank_ties', type=str, default='optimistic', choices=['optimistic', 'pessimistic', 'realistic'], help='How ties with the target count towards its rank (default: optimistic)')
+    parser.add_argument('--eval_mem_mb', type=int, default=512, help='Memory budget in MB for one chunk of the entity sweep during ranking (default: 512)')
+    parser.add_argument('--eval_workers', type=int, default=1, help='CPU processes ranking test shards in parallel, ignored with CUDA (default: 1)')
     parser.add_argument('--valid_freq', type=int, default=99, help='Validate frequency in epochs (default: 50)')
+    parser.add_argument('--async_eval', action='store_true', help='Validate queued checkpoints in a background worker process instead of inline')
+    parser.add_argument('--queue_dir', type=str, default=None, help='Checkpoint queue for --async_eval (default: <outname_base>_eval_queue)')
     parser.add_argument('--print_freq', type=int, default=5, help='Print frequency in epochs (default: 5)')
     parser.add_argument('--embed_dim', type=int, default=20, help='Embedding dimension (default: 50)')
     parser.add_argument('--lr', type=float, default=0.01, help='Learning rate (default: 0.001)')
     parser.add_argument('--margin', type=float, default=3, help='Loss margin (default: 1)')
     parser.add_argument('--p', type=int, default=1, help='P value for p-norm (default: 1)')
     parser.add_argument('--prefetch_to_gpu', type=int, default=0, help="")
+    parser.add_argument('--batch_iter', type=int, default=1, help='Serve training batches as one permutation per epoch and one index gather per batch, instead of per-row DataLoader collation (default: 1)')
     parser.add_argument('--full_loss_penalty', type=int, default=0, help="")
     parser.add_argument('--filter_false_negs', type=int, default=1, help="filter out sampled false negatives")
     parser.add_argument('--seed', type=int, default=0, help='random seed')
@@ -86,10 +96,35 @@ def parse_args():
     args = parser.parse_args()
     args.use_cuda = torch.cuda.is_available()
     args.device = torch.device("cuda" if args.use_cuda else "cpu")
+    if not os.path.exists(args.save_dir):
+        os.makedirs(args.save_dir)
+
+    args.outname_base = os.path.join(args.save_dir,args.namestr+'_MovieLens_results')
+    args.saved_path = os.path.join(args.save_dir,args.namestr+'_MovieLens_resultsD_final.pts')
+    args.gender_filter_saved_path = args.outname_base + 'GenderFilter.pts'
+    args.occupation_filter_saved_path = args.outname_base + 'OccupationFilter.pts'
+    args.age_filter_saved_path = args.outname_base + 'AgeFilter.pts'
+    args.random_filter_saved_path = args.outname_base + 'RandomFilter.pts'
+
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed_all(args.seed)
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+
+    ##############################################################
+    return args
+
+def load_data(args):
+    ''' Ratings, side channels and user splits of the chosen MovieLens set,
+    read from the typed columns preprocess_movie_lens caches on first use.
+    Splits are drawn from args.seed and cached per seed '''
     if not args.use_1M:
         args.train_ratings,args.test_ratings,args.users,args.movies = make_dataset(True)
+        cutoff_constant, data_dir = 0.8, ML_100K_DIR
     else:
-        args.train_ratings,args.test_ratings,args.users,args.movies = make_dataset_1M(True)
+        args.train_ratings,args.test_ratings,args.users,args.movies = \
+                make_dataset_1M(True, seed=args.seed)
+        cutoff_constant, data_dir = 0.9, ML_1M_DIR
 
     ''' Offset Movie ID's by # users because in TransD they share the same
     embedding Layer '''
@@ -104,35 +139,37 @@ def parse_args():
     args.num_movies = int(np.max(args.movies['movie_id'])) + 1
     args.num_ent = args.num_users + args.num_movies
     args.num_rel = 5
-    users = np.asarray(list(set(args.users['user_id'])))
-    np.random.shuffle(users)
-    if args.use_1M:
-        cutoff_constant = 0.9
-    else:
-        cutoff_constant = 0.8
-    train_cutoff_row = int(np.round(len(users)*cutoff_constant))
-    args.cutoff_row = train_cutoff_row
-    args.users_train = users[:train_cutoff_row]
-    args.users_test = users[train_cutoff_row:]
-    if not os.path.exists(args.save_dir):
-        os.makedirs(args.save_dir)
-
-    args.outname_base = os.path.join(args.save_dir,args.namestr+'_MovieLens_results')
-    args.saved_path = os.path.join(args.save_dir,args.namestr+'_MovieLens_resultsD_final.pts')
-    args.gender_filter_saved_path = args.outname_base + 'GenderFilter.pts'
-    args.occupation_filter_saved_path = args.outname_base + 'OccupationFilter.pts'
-    args.age_filter_saved_path = args.outname_base + 'AgeFilter.pts'
-    args.random_filter_saved_path = args.outname_base + 'RandomFilter.pts'
-
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed_all(args.seed)
-    np.random.seed(args.seed)
-    random.seed(args.seed)
-
-    ##############################################################
+    args.users_train, args.users_test = split_users(args.users['user_id'].values,\
+            args.seed, cutoff_constant, data_dir)
+    args.cutoff_row = len(args.users_train)
     return args
 
+def evaluate_checkpoint(epoch, modules, args, test_set, test_fairness_set):
+    ''' Validation of a queued checkpoint, run by the async_eval worker '''
+    modelD = modules['modelD']
+    filter_set = [modules['gender_filter'],modules['occupation_filter'],\
+            modules['age_filter'],None]
+    metrics = {}
+    with torch.no_grad():
+        if args.use_gcmc:
+            metrics['RMSE'], metrics['Test Loss'] = test_gcmc(test_set,args,modelD,filter_set)
+        else:
+            metrics['Test Model Accuracy'], metrics['Test Model AUC'],\
+                    metrics['Test Model RMSE'] = test_nce(test_set,args,modelD,epoch,None)
+
+    tests = [('gender', test_gender), ('occupation', test_occupation),\
+            ('age', test_age), ('random', test_random)]
+    for attribute, test_attr in tests:
+        fairD = modules['fairD_' + attribute]
+        if fairD is not None:
+            acc, AUC, f1 = test_attr(args,test_fairness_set,modelD,fairD,None,epoch,filter_set)
+            metrics['Test '+attribute+' Accuracy'] = acc
+            metrics['Test '+attribute+' AUC'] = AUC
+            metrics['Test '+attribute+' F1'] = f1
+    return metrics
+
 def main(args):
+    load_data(args)
     train_set = KBDataset(args.train_ratings, args.prefetch_to_gpu)
     test_set = KBDataset(args.test_ratings, args.prefetch_to_gpu)
     train_fairness_set = NodeClassification(args.users_train, args.prefetch_to_gpu)
@@ -142,9 +179,6 @@ def main(args):
     else:
         train_hash = set([r.tobytes() for r in train_set.dataset])
 
-    all_hash = train_hash.copy()
-    all_hash.update(set([r.tobytes() for r in test_set.dataset]))
-
     ''' Comet Logging '''
     experiment = Experiment(api_key=args.api_key, disabled= not args.do_log
                         ,project_name=args.project_name,workspace=args.workspace)
@@ -246,8 +280,11 @@ def main(args):
     _cst_s_nb = torch.LongTensor(np.arange(args.batch_size//2,args.batch_size)).to(args.device)
     _cst_nb = torch.LongTensor(np.arange(args.batch_size)).to(args.device)
 
-    if args.prefetch_to_gpu:
-        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
+    if args.batch_iter:
+        train_loader = BatchLoader(train_set, args.batch_size, shuffle=True, drop_last=True,
+                                   pin_memory=args.use_cuda and not args.prefetch_to_gpu)
+    elif args.prefetch_to_gpu:
+        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=False, drop_last=True,
                                   num_workers=0, collate_fn=collate_fn)
     else:
         train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
@@ -262,15 +299,35 @@ def main(args):
 
     ''' Joint Training '''
     if not args.dont_train:
+        if args.async_eval:
+            args.queue_dir = args.queue_dir or args.outname_base + '_eval_queue'
+            eval_modules = {'modelD': modelD, 'gender_filter': gender_filter,\
+                    'occupation_filter': occupation_filter, 'age_filter': age_filter,\
+                    'fairD_gender': fairD_gender, 'fairD_occupation': fairD_occupation,\
+                    'fairD_age': fairD_age, 'fairD_random': fairD_random}
+            worker_args = copy.copy(args)
+            worker_args.do_log = False
+            logged_epochs = set()
+            eval_worker = start_worker(args.queue_dir, evaluate_checkpoint,\
+                    eval_modules, (worker_args, test_set, test_fairness_set),\
+                    str(args.device))
         with experiment.train():
             for epoch in tqdm(range(1, args.num_epochs + 1)):
-
-                if epoch % args.valid_freq == 0 or epoch == 1:
+                if args.prefetch_to_gpu and not args.batch_iter:
+                    ''' The loader reads the GPU-resident rows in order, so they
+                    are permuted on the device once per epoch '''
+                    train_set.shuffle()
+
+                if (epoch % args.valid_freq == 0 or epoch == 1) and args.async_eval:
+                    submit_checkpoint(args.queue_dir, epoch, eval_modules)
+                    for metrics in drain_metrics(args.queue_dir, logged_epochs):
+                        log_metrics(experiment, metrics)
+                elif epoch % args.valid_freq == 0 or epoch == 1:
                     with torch.no_grad():
                         if args.use_gcmc:
                             rmse,test_loss = test_gcmc(test_set,args,modelD,filter_set)
                         else:
-                            # l_ranks,r_ranks,avg_mr,avg_mrr,avg_h10,avg_h5 = test(test_set, args, all_hash,\
+                            # l_ranks,r_ranks,avg_mr,avg_mrr,avg_h10,avg_h5 = test(test_set, args, all_known,\
                                     # modelD,subsample=20)
                             test_nce(test_set,args,modelD,epoch,experiment)
 
@@ -305,15 +362,19 @@ def main(args):
                         fairD_set,optimizer_fairD_set,filter_set,experiment)
                 gc.collect()
 
-                if epoch % (args.valid_freq * 5) == 0:
+                if epoch % (args.valid_freq * 5) == 0 and not args.async_eval:
                     if args.use_gcmc:
                         rmse = test_gcmc(test_set, args, modelD)
                     else:
                         test_nce(test_set,args,modelD,epoch,experiment)
-                        # l_ranks,r_ranks,avg_mr,avg_mrr,avg_h10,avg_h5 = test(test_set,args, all_hash,\
+                        # l_ranks,r_ranks,avg_mr,avg_mrr,avg_h10,avg_h5 = test(test_set,args, all_known,\
                                 # modelD,subsample=20)
+        if args.async_eval:
+            finish_worker(args.queue_dir, eval_worker)
+            for metrics in drain_metrics(args.queue_dir, logged_epochs):
+                log_metrics(experiment, metrics)
         # if not args.use_gcmc:
-            # l_ranks,r_ranks,avg_mr,avg_mrr,avg_h10,avg_h5 = test(test_set,args, all_hash, modelD)
+            # l_ranks,r_ranks,avg_mr,avg_mrr,avg_h10,avg_h5 = test(test_set,args, all_known, modelD)
             # joblib.dump({'l_ranks':l_ranks, 'r_ranks':r_ranks}, args.outname_base+'test_ranks.pkl', compress=9)
 
         modelD.save(args.outname_base+'D_final.pts')
@@ -21,10 +21,12 @@ import torch.nn.functional as F
 import shutil
 import torch.optim as optim
 from torch.autograd import Variable
+from torch.utils.data import BatchSampler, RandomSampler
 from utils import *
 from model import *
 from train_reddit import *
 from eval_reddit import *
+from samplers import SharedNegatives
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -42,6 +44,12 @@ def parse_args():
             default='master_G_graph.pkl', help="output path")
     parser.add_argument('--save_master_k_core', type=str,\
             default='master_G_k_core_graph.pkl', help="output path")
+    parser.add_argument('--save_k_core_edges', type=str,\
+            default='master_G_k_core_edges.npz', help="k-core edge arrays, "\
+            "used over the gpickle when present")
+    parser.add_argument('--artifact', type=str, default='', help='Directory '\
+            'from build_reddit_artifact.py, memory-mapped instead of loading '\
+            'and preprocessing the graph (default: off)')
     parser.add_argument('--use_gcmc', type=bool, default=False, help='Use a GCMC')
     parser.add_argument('--api_key', type=str, default=" ", help="Api key for Comet ml")
     parser.add_argument('--project_name', type=str, default=" ", help="Comet project_name")
@@ -55,6 +63,8 @@ def parse_args():
     parser.add_argument('--freeze_encoder', action='store_true', help="Freeze Main Model")
     parser.add_argument('--use_multi', action='store_true', help="Use Multi-GPU")
     parser.add_argument('--num_nce', type=int, default=1, help='Number of NCE negatives')
+    parser.add_argument('--neg_pool', type=int, default=-1, help='Shared negatives scored as a (B, P) matrix: 0 uses the users/subreddits of the batch, P > 0 a pool of P random ones, -1 draws num_nce corruptions per edge (default: -1)')
+    parser.add_argument('--neg_pool_mb', type=int, default=1024, help='Memory budget in MB for the (B, P) shared negative step; larger pools are capped to fit (default: 1024)')
     parser.add_argument('--lr', type=float, default=0.01, help='Learning rate (default: 0.001)')
     parser.add_argument('--namestr', type=str, default='', help='additional info in output filename to help identify experiments')
     parser.add_argument('--debug', action='store_true', help='Stop before Train Loop')
@@ -112,37 +122,75 @@ def collate_fn(batch):
 
 def main(args):
     ''' Preamble '''
-    save_path_base = "./reddit_data/Reddit_split_2017-11/split_csv/"
-    save_path_k_core = save_path_base + str(args.k_core) + \
-            '_' + args.save_master_k_core
-    G = nx.read_gpickle(save_path_k_core)
-    top_nodes_G = sorted(G.degree, key=lambda x: x[1], \
-            reverse=True)[args.skip_n:101+args.skip_n]
-    top_nodes_G = [n for n in top_nodes_G if n[0].split('_')[0] != 'U']
-    sensitive_nodes = random.sample(top_nodes_G,args.num_sensitive)
-    u_to_idx, sr_to_idx = reddit_mappings(list(G.nodes()))
-    args.num_users = len(u_to_idx)
-    args.num_sr = len(sr_to_idx)
     cutoff_constant = 0.9
-    reddit_check_edges(list(G.edges()))
-    train_cutoff_row = int(np.round(len(G.edges())*cutoff_constant))
-    users_cutoff_row = int(np.round(len(u_to_idx)*cutoff_constant))
-    args.cutoff_row = train_cutoff_row
-    args.users_cutoff_row = users_cutoff_row
-    all_users = list(u_to_idx)
-    random.shuffle(all_users)
-    ''' Train/Test Splits '''
-    args.users_train = [u_to_idx[user] for user in all_users[:args.users_cutoff_row]]
-    args.users_test = [u_to_idx[user] for user in all_users[args.users_cutoff_row:]]
-    train_set = RedditDataset(list(G.edges())[:args.cutoff_row],u_to_idx,sr_to_idx)
-    test_set = RedditDataset(list(G.edges())[args.cutoff_row:],u_to_idx,sr_to_idx)
+    if args.artifact:
+        G = RedditArtifact(args.artifact, args.seed)
+        top_nodes_G = G.top_subreddits(args.skip_n)
+        sensitive_nodes = random.sample(top_nodes_G,args.num_sensitive)
+        u_to_idx, sr_to_idx = G.u_to_idx, G.sr_to_idx
+        args.num_users = len(u_to_idx)
+        args.num_sr = len(sr_to_idx)
+        args.cutoff_row = len(G.train_edges)
+        args.users_cutoff_row = len(G.train_users)
+        args.users_train = np.array(G.train_users)
+        args.users_test = np.array(G.test_users)
+        train_set = RedditDataset(None,u_to_idx,sr_to_idx,encoded=G.train_edges)
+        test_set = RedditDataset(None,u_to_idx,sr_to_idx,encoded=G.test_edges)
+    else:
+        save_path_base = "./reddit_data/Reddit_split_2017-11/split_csv/"
+        save_path_k_core = save_path_base + str(args.k_core) + \
+                '_' + args.save_master_k_core
+        save_path_k_core_edges = save_path_base + str(args.k_core) + \
+                '_' + args.save_k_core_edges
+        if os.path.exists(save_path_k_core_edges):
+            save_path_k_core = save_path_k_core_edges
+        G = load_reddit_graph(save_path_k_core)
+        top_nodes_G = sorted(G.degree, key=lambda x: x[1], \
+                reverse=True)[args.skip_n:101+args.skip_n]
+        top_nodes_G = [n for n in top_nodes_G if n[0].split('_')[0] != 'U']
+        sensitive_nodes = random.sample(top_nodes_G,args.num_sensitive)
+        u_to_idx, sr_to_idx = reddit_mappings(list(G.nodes()))
+        args.num_users = len(u_to_idx)
+        args.num_sr = len(sr_to_idx)
+        if not isinstance(G, RedditGraph):
+            reddit_check_edges(list(G.edges()))
+        train_cutoff_row = int(np.round(G.number_of_edges()*cutoff_constant))
+        users_cutoff_row = int(np.round(len(u_to_idx)*cutoff_constant))
+        args.cutoff_row = train_cutoff_row
+        args.users_cutoff_row = users_cutoff_row
+        all_users = list(u_to_idx)
+        random.shuffle(all_users)
+        ''' Train/Test Splits '''
+        args.users_train = [u_to_idx[user] for user in all_users[:args.users_cutoff_row]]
+        args.users_test = [u_to_idx[user] for user in all_users[args.users_cutoff_row:]]
+        if isinstance(G, RedditGraph):
+            ''' The npz edges come out of np.unique sorted user-major, so
+            cutting them as stored would put the alphabetically last users
+            wholly in test. Cut a seeded permutation instead '''
+            perm = np.random.RandomState(args.seed).permutation(len(G.edge_array))
+            encoded = G.edge_array[perm]
+            train_edges, test_edges = None, None
+        else:
+            edges = list(G.edges())
+            encoded = load_reddit_edges(save_path_k_core, edges, u_to_idx, sr_to_idx)
+            train_edges, test_edges = edges[:args.cutoff_row], edges[args.cutoff_row:]
+        train_set = RedditDataset(train_edges,u_to_idx,sr_to_idx,\
+                encoded=encoded[:args.cutoff_row])
+        test_set = RedditDataset(test_edges,u_to_idx,sr_to_idx,\
+                encoded=encoded[args.cutoff_row:])
+    if args.neg_pool >= 0:
+        args.shared_negs = SharedNegatives(args.neg_pool, (0, 1),\
+                (args.num_users, args.num_sr), max_mb=args.neg_pool_mb)
+    else:
+        args.shared_negs = None
     train_fairness_set = NodeClassification(args.users_train,args.prefetch_to_gpu)
     test_fairness_set = NodeClassification(args.users_test,args.prefetch_to_gpu)
     if args.filter_false_negs:
-        train_hash = set([(train_set.get_mapping(r)).numpy().tobytes() for r in train_set.dataset])
-        all_hash = train_hash.copy()
-        all_hash.update(set([(test_set.get_mapping(r)).numpy().tobytes()\
-                for r in test_set.dataset]))
+        train_rows = torch.from_numpy(train_set.encoded)
+        test_rows = torch.from_numpy(test_set.encoded)
+        sizes = (args.num_users, args.num_sr)
+        train_hash = PackedKeys(train_rows, sizes, device=args.device)
+        all_hash = PackedKeys(torch.cat([train_rows, test_rows]), sizes, device=args.device)
     else:
         train_hash = None
         all_hash = None
@@ -202,13 +250,14 @@ def main(args):
     experiment.set_name(args.namestr)
 
     ''' Train Loop '''
-    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
-                              num_workers=8, pin_memory=True, collate_fn=collate_fn)
+    ''' Each fetch gathers a whole batch of rows from the encoded edges '''
+    train_loader = DataLoader(train_set, batch_size=None, num_workers=8, pin_memory=True,
+                              sampler=BatchSampler(RandomSampler(train_set), args.batch_size, drop_last=True))
     # train_compositional_reddit_classifier(args,modelD,G,sensitive_nodes,\
             # u_to_idx,train_fairness_set,test_fairness_set,experiment,all_masks,filter_set=filter_set)
     with experiment.train():
         for epoch in tqdm(range(1, args.num_epochs + 1)):
-            train_fair_reddit(train_loader,all_hash,epoch,args,modelD,optimizerD,\
+            train_fair_reddit(train_loader,train_hash,epoch,args,modelD,optimizerD,\
                     fairD_set, optimizer_fairD_set, filter_set, train_masks, experiment)
 
             if epoch % args.valid_freq == 0:
@@ -70,6 +70,14 @@ def apply_filters_transd(p_lhs_emb,p_rhs_emb,masked_filter_set):
             filter_r_emb += filter_(p_rhs_emb)
     return filter_l_emb,filter_r_emb
 
+def pairwise_l2(queries, cands):
+    ''' (B, P) L2 distances between two sets of rows, expanded as
+    |q|^2 - 2 q.c + |c|^2 so that only a GEMM touches both sets '''
+    sq = (queries * queries).sum(dim=1, keepdim=True)\
+            - 2 * torch.mm(queries, cands.t())\
+            + (cands * cands).sum(dim=1).unsqueeze(0)
+    return sq.clamp(min=1e-12).sqrt()
+
 class RedditEncoder(nn.Module):
     def __init__(self, num_users, num_sr, embed_dim, p):
         super(RedditEncoder, self).__init__()
@@ -96,6 +104,18 @@ class RedditEncoder(nn.Module):
         else:
             return enrgs,users_embed,sr_embed
 
+    def score_candidates(self, batch, side, filters=None, ents=None):
+        ''' Energies of every user (side 0) or subreddit (side 1) in `ents`
+        paired with the other column of each edge, shape (B, len(ents)) '''
+        if ents is None:
+            size = self.num_users if side == 0 else self.num_sr
+            ents = torch.arange(size, dtype=torch.long, device=batch.device)
+        if side == 0:
+            cands, fixed = self.encode(ents, batch[:,1], filters)
+        else:
+            fixed, cands = self.encode(batch[:,0], ents, filters)
+        return -1*torch.mm(fixed, cands.t())
+
     def get_embed(self, users, filters=None):
         with torch.no_grad():
             user_embed = self.user_embeds(users)
@@ -125,14 +145,18 @@ class RedditDiscriminator(nn.Module):
         super(RedditDiscriminator, self).__init__()
         self.embed_dim = int(embed_dim)
         self.u_to_idx = u_to_idx
-        self.G_neighbors = set(G.neighbors(sensitive_sr))
         self.attribute = sensitive_sr
         if use_cross_entropy:
             self.cross_entropy = True
         else:
             self.cross_entropy = False
 
-        self.users_sensitive = self.create_sensitive_labels(self.G_neighbors,self.u_to_idx)
+        if hasattr(G, 'sensitive_labels'):
+            ''' A RedditArtifact keeps the membership column as CSR '''
+            self.users_sensitive = G.sensitive_labels(sensitive_sr)
+        else:
+            self.G_neighbors = set(G.neighbors(sensitive_sr))
+            self.users_sensitive = self.create_sensitive_labels(self.G_neighbors,self.u_to_idx)
         self.out_dim = 1
         self.sigmoid = nn.Sigmoid()
         self.criterion = nn.BCELoss()
@@ -233,6 +257,34 @@ class TransE(nn.Module):
             return enrgs,lhs_es,rhs_es,rel_es
         return enrgs
 
+    def score_candidates(self, triplets, side, filters=None, ents=None):
+        ''' Energies of every entity in `ents` (default: all of them) placed
+        at column `side` (0 = lhs, 2 = rhs) of each triplet, shape (B, len(ents)) '''
+        rel_es = self.rel_embeds(triplets[:, 1])
+        if ents is None:
+            ents = torch.arange(self.num_ent, dtype=torch.long, device=triplets.device)
+        cands = self.ent_embeds(ents).unsqueeze(0)
+        if side == 0:
+            rhs_es = self.ent_embeds(triplets[:, 2])
+            diff = cands + (rel_es - rhs_es).unsqueeze(1)
+        else:
+            lhs_es = self.ent_embeds(triplets[:, 0])
+            diff = (lhs_es + rel_es).unsqueeze(1) - cands
+        return diff.norm(p=self.p, dim=2)
+
+    def pool_energies(self, triplets, side, ents, filters=None):
+        ''' score_candidates against a shared pool `ents` as (B, P) L2
+        distances of (h + r) or (t - r) to the pool, without the (B, P,
+        embed_dim) difference tensor. None for p != 2 '''
+        if self.p != 2:
+            return None
+        rel_es = self.rel_embeds(triplets[:, 1])
+        if side == 0:
+            queries = self.ent_embeds(triplets[:, 2]) - rel_es
+        else:
+            queries = self.ent_embeds(triplets[:, 0]) + rel_es
+        return pairwise_l2(queries, self.ent_embeds(ents))
+
     def get_embed(self, ents, rel_idxs=None):
         ent_embed = self.ent_embeds(ents)
         return ent_embed
@@ -268,6 +320,71 @@ class TransE(nn.Module):
     def load(self, fn):
         self.load_state_dict(torch.load(fn))
 
+class ProjectionCache(object):
+    ''' Projected entity tables P_r = E + (E . E_transfer) r_transfer of a
+    TransD model, built lazily per relation (with `filters` applied) and
+    evicted least recently used first once they exceed `max_mb` megabytes.
+    Only valid while the model's weights do not change '''
+    def __init__(self, modelD, max_mb, filters=None):
+        self.modelD = modelD
+        self.max_bytes = max_mb * 2**20
+        self.filters = filters
+        self.tables = OrderedDict()
+        self.used = 0
+        self.es, self.dots = None, None
+
+    def _base(self, device):
+        if self.es is None:
+            ents = torch.arange(self.modelD.num_ent, dtype=torch.long, device=device)
+            with torch.no_grad():
+                self.es = self.modelD._ent_embeds(ents)
+                self.dots = (self.es * self.modelD.ent_transfer(ents)).sum(dim=1, keepdim=True)
+        return self.es, self.dots
+
+    def __getitem__(self, rel):
+        if rel in self.tables:
+            self.tables.move_to_end(rel)
+            return self.tables[rel]
+
+        es, dots = self._base(self.modelD.rel_transfer.weight.device)
+        with torch.no_grad():
+            rel_t = self.modelD.rel_transfer(torch.tensor([rel], device=es.device))
+            table = es + dots * rel_t
+            if self.filters is not None:
+                constant = len(self.filters) - self.filters.count(None)
+                if constant !=0:
+                    table = apply_filters_single_node(table, self.filters)
+
+        size = table.numel() * table.element_size()
+        while self.tables and self.used + size > self.max_bytes:
+            _, old = self.tables.popitem(last=False)
+            self.used -= old.numel() * old.element_size()
+        self.tables[rel] = table
+        self.used += size
+        return table
+
+    def score_candidates(self, triplets, side, ents=None):
+        ''' TransD.score_candidates served from the cached tables. Queries
+        are grouped by relation: each group gathers its fixed entities and
+        candidates from one table and is scored as a single (h + r) - P_r
+        (or P_r + r - t) broadcast, written back to the group's rows '''
+        rel_idxs = triplets[:, 1]
+        rel_es = self.modelD.rel_embeds(rel_idxs)
+        fixed_idxs = triplets[:, 2] if side == 0 else triplets[:, 0]
+        num_cands = self.modelD.num_ent if ents is None else len(ents)
+        enrgs = rel_es.new_empty(len(triplets), num_cands)
+        for rel in torch.unique(rel_idxs).tolist():
+            rows = torch.nonzero(rel_idxs == rel).view(-1)
+            table = self[rel]
+            cands = (table if ents is None else table[ents]).unsqueeze(0)
+            fixed = table[fixed_idxs[rows]]
+            if side == 0:
+                diff = cands + (rel_es[rows] - fixed).unsqueeze(1)
+            else:
+                diff = (fixed + rel_es[rows]).unsqueeze(1) - cands
+            enrgs[rows] = diff.norm(p=self.modelD.p, dim=2)
+        return enrgs
+
 class TransD(nn.Module):
     def __init__(self, num_ent, num_rel, embed_dim, p):
         super(TransD, self).__init__()
@@ -275,6 +392,7 @@ class TransD(nn.Module):
         self.num_rel = num_rel
         self.embed_dim = embed_dim
         self.p = p
+        self.proj_cache = None
 
         r = 6 / np.sqrt(self.embed_dim)
 
@@ -320,6 +438,75 @@ class TransD(nn.Module):
             enrgs = (lhs + rel_es - rhs).norm(p=self.p, dim=1)
             return enrgs,lhs,rhs
 
+    def score_candidates(self, triplets, side, filters=None, ents=None):
+        ''' Energies of every entity in `ents` (default: all of them) placed
+        at column `side` (0 = lhs, 2 = rhs) of each triplet, shape
+        (B, len(ents)). The projection scalar (e . e_transfer) does not depend
+        on the relation, so the candidate matrix is a broadcast against the
+        entity table '''
+        if self.proj_cache is not None and filters == self.proj_cache.filters:
+            return self.proj_cache.score_candidates(triplets, side, ents=ents)
+        rel_idxs = triplets[:, 1]
+        rel_es = self.rel_embeds(rel_idxs)
+        rel_ts = self.rel_transfer(rel_idxs)
+        if ents is None:
+            ents = torch.arange(self.num_ent, dtype=torch.long, device=triplets.device)
+        es = self._ent_embeds(ents)
+        dots = (es * self.ent_transfer(ents)).sum(dim=1)
+        cands = es.unsqueeze(0) + dots.view(1, -1, 1) * rel_ts.unsqueeze(1)
+        if side == 0:
+            fixed = self.ent_embeds(triplets[:, 2], rel_idxs)
+        else:
+            fixed = self.ent_embeds(triplets[:, 0], rel_idxs)
+        if filters is not None:
+            constant = len(filters) - filters.count(None)
+            if constant !=0:
+                fixed = apply_filters_single_node(fixed,filters)
+                cands = apply_filters_single_node(cands.view(-1, self.embed_dim),\
+                        filters).view(len(triplets), len(ents), -1)
+
+        if side == 0:
+            diff = cands + (rel_es - fixed).unsqueeze(1)
+        else:
+            diff = (fixed + rel_es).unsqueeze(1) - cands
+        return diff.norm(p=self.p, dim=2)
+
+    def pool_energies(self, triplets, side, ents, filters=None):
+        ''' score_candidates against a shared pool `ents`, shape (B, P).
+        Each pool entity is projected per relation as c + d_c r_t with
+        d_c = c . c_transfer, so |a - c - d_c r_t|^2 expands into GEMMs of
+        the queries and of r_t against the pool. None for p != 2 or active
+        filters, which do not expand '''
+        if self.p != 2 or (filters is not None and\
+                len(filters) - filters.count(None) != 0):
+            return None
+        rel_idxs = triplets[:, 1]
+        rel_es = self.rel_embeds(rel_idxs)
+        rel_ts = self.rel_transfer(rel_idxs)
+        if side == 0:
+            queries = self.ent_embeds(triplets[:, 2], rel_idxs) - rel_es
+        else:
+            queries = self.ent_embeds(triplets[:, 0], rel_idxs) + rel_es
+        cands = self._ent_embeds(ents)
+        dots = (cands * self.ent_transfer(ents)).sum(dim=1).unsqueeze(0)
+        q_rt = (queries * rel_ts).sum(dim=1, keepdim=True)
+        rt_sq = (rel_ts * rel_ts).sum(dim=1, keepdim=True)
+        sq = (queries * queries).sum(dim=1, keepdim=True)\
+                + (cands * cands).sum(dim=1).unsqueeze(0)\
+                + dots * dots * rt_sq\
+                - 2 * torch.mm(queries, cands.t())\
+                - 2 * dots * q_rt\
+                + 2 * dots * torch.mm(rel_ts, cands.t())
+        return sq.clamp(min=1e-12).sqrt()
+
+    def cache_projections(self, max_mb, filters=None):
+        ''' Serve score_candidates from per-relation projected entity tables
+        kept under `max_mb` megabytes; max_mb=0 drops the cache. Call again
+        with 0 before the weights are updated '''
+        self.proj_cache = None
+        if max_mb > 0:
+            self.proj_cache = ProjectionCache(self, max_mb, filters=filters)
+
     def get_embed(self, ents, rel_idxs, filters=None):
         with torch.no_grad():
             ent_embed = self.ent_embeds(ents, rel_idxs)
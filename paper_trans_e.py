@@ -20,9 +20,11 @@ import json
 import logging
 import sys, os
 import subprocess
-from model import FBDemParDisc,AttributeFilter
+from model import FBDemParDisc,AttributeFilter,ProjectionCache
 from tqdm import tqdm
-from utils import create_or_append, compute_rank, NodeClassification
+from samplers import UniformSampler, BernoulliSampler
+from utils import create_or_append, compute_rank, NodeClassification, KnownTriples, PackedKeys, BatchLoader, load_triples, vocab_sizes, shuffle_rows
+from eval_kb import rank_triplets, test_sequential
 import joblib
 from collections import Counter
 import ipdb
@@ -100,6 +102,7 @@ class TransD(nn.Module):
         self.num_rel = num_rel
         self.embed_dim = embed_dim
         self.p = p
+        self.proj_cache = None
 
         r = 6 / np.sqrt(self.embed_dim)
 
@@ -145,6 +148,44 @@ class TransD(nn.Module):
             enrgs = (lhs + rel_es - rhs).norm(p=self.p, dim=1)
             return enrgs,lhs,rhs
 
+    def score_candidates(self, triplets, side, filters=None, ents=None):
+        ''' Energies of every entity in `ents` (default: all of them) placed
+        at column `side` (0 = lhs, 2 = rhs) of each triplet, shape (B, len(ents)) '''
+        if self.proj_cache is not None and filters == self.proj_cache.filters:
+            return self.proj_cache.score_candidates(triplets, side, ents=ents)
+        rel_idxs = triplets[:, 1]
+        rel_es = self.rel_embeds(rel_idxs)
+        rel_ts = self.rel_transfer(rel_idxs)
+        if ents is None:
+            ents = torch.arange(self.num_ent, dtype=torch.long, device=triplets.device)
+        es = self._ent_embeds(ents)
+        dots = (es * self.ent_transfer(ents)).sum(dim=1)
+        cands = es.unsqueeze(0) + dots.view(1, -1, 1) * rel_ts.unsqueeze(1)
+        if side == 0:
+            fixed = self.ent_embeds(triplets[:, 2], rel_idxs)
+        else:
+            fixed = self.ent_embeds(triplets[:, 0], rel_idxs)
+        if filters is not None:
+            constant = len(filters) - filters.count(None)
+            if constant !=0:
+                fixed = apply_filters_single_node(fixed,filters)
+                cands = apply_filters_single_node(cands.view(-1, self.embed_dim),\
+                        filters).view(len(triplets), len(ents), -1)
+
+        if side == 0:
+            diff = cands + (rel_es - fixed).unsqueeze(1)
+        else:
+            diff = (fixed + rel_es).unsqueeze(1) - cands
+        return diff.norm(p=self.p, dim=2)
+
+    def cache_projections(self, max_mb, filters=None):
+        ''' Serve score_candidates from per-relation projected entity tables
+        kept under `max_mb` megabytes; max_mb=0 drops the cache. Call again
+        with 0 before the weights are updated '''
+        self.proj_cache = None
+        if max_mb > 0:
+            self.proj_cache = ProjectionCache(self, max_mb, filters=filters)
+
     def get_embed(self, ents, rel_idxs, filters=None):
         with torch.no_grad():
             ent_embed = self.ent_embeds(ents, rel_idxs)
@@ -313,7 +354,7 @@ class KBDataset(Dataset):
     def __init__(self, path, attribute_data=None,prefetch_to_gpu=False):
         self.prefetch_to_gpu = prefetch_to_gpu
         if isinstance(path, str):
-            self.dataset = np.ascontiguousarray(np.array(pickle.load(open(path, 'rb'))))
+            self.dataset = load_triples(path)
         elif isinstance(path, np.ndarray):
             self.dataset = np.ascontiguousarray(path)
         else:
@@ -326,16 +367,7 @@ class KBDataset(Dataset):
         return self.dataset[idx]
 
     def shuffle(self):
-        if self.dataset.is_cuda:
-            self.dataset = self.dataset.cpu()
-
-        data = self.dataset.numpy()
-        np.random.shuffle(data)
-        data = np.ascontiguousarray(data)
-        self.dataset = ltensor(data)
-
-        if self.prefetch_to_gpu:
-            self.dataset = self.dataset.cuda().contiguous()
+        self.dataset = shuffle_rows(self.dataset, self.prefetch_to_gpu)
 
 def collate_fn(batch):
     if isinstance(batch, np.ndarray) or (isinstance(batch, list) and isinstance(batch[0], np.ndarray)):
@@ -343,23 +375,8 @@ def collate_fn(batch):
     else:
         return torch.stack(batch).contiguous()
 
-_cb_var = []
-def corrupt_batch(batch, num_ent):
-    # batch: ltensor type, contains positive triplets
-    batch_size, _ = batch.size()
-
-    corrupted = batch.clone()
-
-    if len(_cb_var) == 0:
-        _cb_var.append(ltensor(batch_size//2).cuda())
-
-    q_samples_l = _cb_var[0].random_(0, num_ent)
-    q_samples_r = _cb_var[0].random_(0, num_ent)
-
-    corrupted[:batch_size//2, 0] = q_samples_l
-    corrupted[batch_size//2:, 2] = q_samples_r
-
-    return corrupted.contiguous(), torch.cat([q_samples_l, q_samples_r])
+''' Uniform head/tail corruption, see samplers.UniformSampler '''
+corrupt_batch = UniformSampler()
 
 '''Monitor Norm of gradients'''
 def monitor_grad_norm(model):
@@ -402,7 +419,14 @@ def parse_args():
     parser.add_argument('--data_dir', type=str, default='./data/', help="Contains Pickle files")
     parser.add_argument('--num_epochs', type=int, default=1000, help='Number of training epochs (default: 500)')
     parser.add_argument('--batch_size', type=int, default=16000, help='Batch size (default: 512)')
+    parser.add_argument('--eval_batch_size', type=int, default=64, help='Test triplets ranked per forward pass (default: 64)')
+    parser.add_argument('--rank_ties', type=str, default='optimistic', choices=['optimistic', 'pessimistic', 'realistic'], help='How ties with the target count towards its rank (default: optimistic)')
+    parser.add_argument('--eval_mem_mb', type=int, default=512, help='Memory budget in MB for one chunk of the entity sweep during ranking (default: 512)')
+    parser.add_argument('--eval_workers', type=int, default=1, help='CPU processes ranking test shards in parallel, ignored with CUDA (default: 1)')
+    parser.add_argument('--proj_cache_mb', type=int, default=1024, help='Memory cap in MB for cached per-relation TransD projections during ranking, 0 disables (default: 1024)')
     parser.add_argument('--valid_freq', type=int, default=20, help='Validate frequency in epochs (default: 50)')
+    parser.add_argument('--valid_tol', type=float, default=0, help='Stop validation once the MRR confidence interval is narrower than this, 0 ranks every 20th triplet instead (default: 0)')
+    parser.add_argument('--valid_seed', type=int, default=0, help='Seed of the triplet order used by --valid_tol (default: 0)')
     parser.add_argument('--print_freq', type=int, default=5, help='Print frequency in epochs (default: 5)')
     parser.add_argument('--embed_dim', type=int, default=50, help='Embedding dimension (default: 50)')
     parser.add_argument('--z_dim', type=int, default=100, help='noise Embedding dimension (default: 100)')
@@ -411,9 +435,11 @@ def parse_args():
     parser.add_argument('--margin', type=float, default=3, help='Loss margin (default: 1)')
     parser.add_argument('--p', type=int, default=1, help='P value for p-norm (default: 1)')
     parser.add_argument('--prefetch_to_gpu', type=int, default=0, help="")
+    parser.add_argument('--batch_iter', type=int, default=1, help='Serve training batches as one permutation per epoch and one index gather per batch, instead of per-row DataLoader collation (default: 1)')
     parser.add_argument('--D_nce_weight', type=float, default=1, help="D nce term weight")
     parser.add_argument('--full_loss_penalty', type=int, default=0, help="")
     parser.add_argument('--filter_false_negs', type=int, default=1, help="filter out sampled false negatives")
+    parser.add_argument('--sampler', type=str, default='uniform', choices=['uniform', 'bernoulli'], help='Negative sampling: head/tail halves of the batch, or per-relation Bernoulli choice (default: uniform)')
     parser.add_argument('--ace', type=int, default=0, help="do ace training (otherwise just NCE)")
     parser.add_argument('--false_neg_penalty', type=float, default=1., help="false neg penalty for G")
     parser.add_argument('--mb_reward_normalization', type=int, default=0, help="minibatch based reward normalization")
@@ -434,8 +460,7 @@ def parse_args():
     if args.dataset == 'WN' or args.dataset == 'FB15k':
         path = './data/' + args.dataset + '-%s.pkl'
 
-        args.num_ent = len(json.load(open('./data/%s-ent_to_idx.json' % args.dataset, 'r')))
-        args.num_rel = len(json.load(open('./data/%s-rel_to_idx.json' % args.dataset, 'r')))
+        args.num_ent, args.num_rel = vocab_sizes(args.dataset)
         args.data_path = path
     else:
         raise Exception("Argument 'dataset' can only be 'WN' or 'FB15k'.")
@@ -548,28 +573,30 @@ def freeze_model(model):
 def main(args):
     if args.dataset in ('FB15k-237', 'kinship', 'nations', 'umls', 'WN18RR', 'YAGO3-10'):
         S = joblib.load(args.data_path)
-        train_set = KBDataset(S['train_data'], args.prefetch_to_gpu)
+        train_set = KBDataset(S['train_data'], prefetch_to_gpu=args.prefetch_to_gpu)
         valid_set = KBDataset(S['val_data'], attr_data)
         test_set = KBDataset(S['test_data'], attr_data)
     else:
-        train_set = KBDataset(args.data_path % 'train', args.prefetch_to_gpu)
+        train_set = KBDataset(args.data_path % 'train', prefetch_to_gpu=args.prefetch_to_gpu)
         valid_set = KBDataset(args.data_path % 'valid')
         test_set = KBDataset(args.data_path % 'test')
         print('50 Most Commone Attributes')
 
-    if args.prefetch_to_gpu:
-        train_hash = set([r.tobytes() for r in train_set.dataset.cpu().numpy()])
+    if args.sampler == 'bernoulli':
+        corrupt = BernoulliSampler(train_set.dataset, args.num_ent, args.num_rel)
     else:
-        train_hash = set([r.tobytes() for r in train_set.dataset])
+        corrupt = corrupt_batch
+
+    train_hash = PackedKeys(train_set.dataset, (args.num_ent, args.num_rel, args.num_ent),\
+            device='cuda' if args.use_cuda else 'cpu')
 
     cutoff_constant = 0.8
     train_cutoff_row = int(np.round(args.num_ent*cutoff_constant))
     args.cutoff_row = train_cutoff_row
     all_ents = np.arange(args.num_ent)
     np.random.shuffle(all_ents)
-    all_hash = train_hash.copy()
-    all_hash.update(set([r.tobytes() for r in valid_set.dataset]))
-    all_hash.update(set([r.tobytes() for r in test_set.dataset]))
+    all_known = KnownTriples([train_set.dataset, valid_set.dataset, test_set.dataset],\
+            args.num_ent, args.num_rel)
     logdir = args.outname_base + '_logs' + '/'
     if args.remove_old_run:
         shutil.rmtree(logdir)
@@ -713,16 +740,10 @@ def main(args):
                 masked_optimizer_fairD_set = optimizer_fairD_set
                 masked_filter_set = filter_set
 
-            nce_batch, q_samples = corrupt_batch(p_batch, args.num_ent)
+            nce_batch, q_samples = corrupt(p_batch, args.num_ent)
 
             if args.filter_false_negs:
-                if args.prefetch_to_gpu:
-                    nce_np = nce_batch.cpu().numpy()
-                else:
-                    nce_np = nce_batch.numpy()
-
-                nce_falseNs = ftensor(np.array([int(x.tobytes() in train_hash) for x in nce_np], dtype=np.float32))
-                nce_falseNs = Variable(nce_falseNs.cuda()) if args.use_cuda else Variable(nce_falseNs)
+                nce_falseNs = train_hash.contains(nce_batch).float()
             else:
                 nce_falseNs = None
 
@@ -1009,52 +1030,17 @@ def main(args):
             experiment.log_metric("Test "+attribute+" AUC",float(AUC),step=epoch)
             experiment.log_metric("Test "+attribute+" Accuracy",float(acc),step=epoch)
 
-    def test(dataset, args, all_hash, modelD, tflogger, filter_set, experiment, subsample=1):
-        l_ranks, r_ranks = [], []
-        test_loader = DataLoader(dataset, num_workers=1, collate_fn=collate_fn)
-
-        cst_inds = np.arange(args.num_ent, dtype=np.int64)[:,None]
-
-        if args.show_tqdm:
-            data_itr = tqdm(enumerate(test_loader))
-        else:
-            data_itr = enumerate(test_loader)
-
-        for idx, triplet in data_itr:
-            if idx % subsample != 0:
-                continue
-
-            lhs, rel, rhs = triplet.view(-1)
-
-            l_batch = np.concatenate([cst_inds, np.array([[rel, rhs]]).repeat(args.num_ent, axis=0)], axis=1)
-            r_batch = np.concatenate([np.array([[lhs, rel]]).repeat(args.num_ent, axis=0), cst_inds], axis=1)
-
-            l_fns = np.array([int(x.tobytes() in all_hash) for x in l_batch], dtype=np.float32)
-            r_fns = np.array([int(x.tobytes() in all_hash) for x in r_batch], dtype=np.float32)
-
-            l_batch = ltensor(l_batch).contiguous()
-            r_batch = ltensor(r_batch).contiguous()
-
-            if args.use_cuda:
-                l_batch = l_batch.cuda()
-                r_batch = r_batch.cuda()
-
-            l_batch = Variable(l_batch)
-            r_batch = Variable(r_batch)
-
-            d_ins = torch.cat([l_batch, r_batch], dim=0)
-            d_outs = modelD(d_ins,filters=filter_set)
-            l_enrgs = d_outs[:len(l_batch)]
-            r_enrgs = d_outs[len(l_batch):]
-
-            l_rank = compute_rank(v2np(l_enrgs), lhs, mask_observed=l_fns)
-            r_rank = compute_rank(v2np(r_enrgs), rhs, mask_observed=r_fns)
-
-            l_ranks.append(l_rank)
-            r_ranks.append(r_rank)
-
-        l_ranks = np.array(l_ranks)
-        r_ranks = np.array(r_ranks)
+    def test(dataset, args, all_known, modelD, tflogger, filter_set, experiment, subsample=1):
+        triplets = dataset.dataset[::subsample]
+        modelD.cache_projections(args.proj_cache_mb, filters=filter_set)
+        try:
+            l_ranks, r_ranks = rank_triplets(triplets, modelD, all_known,\
+                    batch_size=args.eval_batch_size, filters=filter_set,\
+                    use_cuda=args.use_cuda, show_tqdm=args.show_tqdm,\
+                    ties=args.rank_ties, mem_budget=args.eval_mem_mb,\
+                    num_workers=args.eval_workers)
+        finally:
+            modelD.cache_projections(0)
 
         return l_ranks, r_ranks
 
@@ -1173,8 +1159,11 @@ def main(args):
                             new_fairD_2,attribute='2',epoch=epoch,\
                             experiment=experiment,filter_=filter_2)
 
-    if args.prefetch_to_gpu:
-        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
+    if args.batch_iter:
+        train_loader = BatchLoader(train_set, args.batch_size, shuffle=True, drop_last=True,
+                                   pin_memory=args.use_cuda and not args.prefetch_to_gpu)
+    elif args.prefetch_to_gpu:
+        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=False, drop_last=True,
                                   num_workers=0, collate_fn=collate_fn)
     else:
         train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
@@ -1183,8 +1172,13 @@ def main(args):
     if args.freeze_transD:
         freeze_model(modelD)
 
+    best_mrr = None
     with experiment.train():
         for epoch in tqdm(range(1, args.num_epochs + 1)):
+            if args.prefetch_to_gpu and not args.batch_iter:
+                ''' The loader reads the GPU-resident rows in order, so they
+                are permuted on the device once per epoch '''
+                train_set.shuffle()
             train(train_loader,epoch,args,train_hash,modelD,optimizerD,\
                     tflogger,fairD_set,optimizer_fairD_set,filter_set,experiment)
             gc.collect()
@@ -1197,8 +1191,12 @@ def main(args):
 
             if epoch % args.valid_freq == 0:
                 with torch.no_grad():
-                    l_ranks, r_ranks = test(valid_set,args,all_hash,\
-                            modelD,tflogger,filter_set,experiment,subsample=20)
+                    if args.valid_tol > 0:
+                        l_ranks, r_ranks = test_sequential(valid_set,args,all_known,\
+                                modelD,filter_set,experiment,best_mrr=best_mrr)
+                    else:
+                        l_ranks, r_ranks = test(valid_set,args,all_known,\
+                                modelD,tflogger,filter_set,experiment,subsample=20)
                     l_mean = l_ranks.mean()
                     r_mean = r_ranks.mean()
                     l_mrr = (1. / l_ranks).mean()
@@ -1211,6 +1209,7 @@ def main(args):
                     avg_mrr = (l_mrr+r_mrr)/2
                     avg_h10 = (l_h10+r_h10)/2
                     avg_h5 = (l_h5+r_h5)/2
+                    best_mrr = avg_mrr if best_mrr is None else max(best_mrr, avg_mrr)
 
                 print("Mean Rank is %f" %(float(avg_mr)))
                 if args.use_attr:
@@ -1245,7 +1244,7 @@ def main(args):
 
                 modelD.save(args.outname_base+'D_epoch{}.pts'.format(epoch))
 
-        l_ranks, r_ranks = test(test_set,args,all_hash,\
+        l_ranks, r_ranks = test(test_set,args,all_known,\
                 modelD,tflogger,filter_set,experiment,subsample=1)
         l_mean = l_ranks.mean()
         r_mean = r_ranks.mean()
@@ -6,6 +6,7 @@ import os
 import json
 import pickle
 import argparse
+import numpy as np
 import ipdb
 
 if 'data' not in os.listdir('./'):
@@ -72,6 +73,16 @@ def main():
     pickle.dump(valid_set, open('./data/%s-valid.pkl' % args.dataset, 'wb'), protocol=-1)
     pickle.dump(test_set, open('./data/%s-test.pkl' % args.dataset, 'wb'), protocol=-1)
 
+    ''' Fixed-width copies the loaders memory-map instead of unpickling '''
+    splits = {'train': train_set, 'valid': valid_set, 'test': test_set}
+    for split, triples in splits.items():
+        np.save('./data/%s-%s.npy' % (args.dataset, split),\
+                np.array(triples, dtype=np.int64).reshape(-1, 3))
+    manifest = {'version': 1, 'dtype': 'int64', 'num_ent': len(ent_to_idx),\
+            'num_rel': len(rel_to_idx),\
+            'counts': {split: len(triples) for split, triples in splits.items()}}
+    json.dump(manifest, open('./data/%s-manifest.json' % args.dataset, 'w'))
+
     json.dump(ent_to_idx, open('./data/%s-ent_to_idx.json' % args.dataset, 'w'))
     json.dump(rel_to_idx, open('./data/%s-rel_to_idx.json' % args.dataset, 'w'))
 
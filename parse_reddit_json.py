@@ -1,28 +1,41 @@
 import argparse
 import pickle
 import json
+import csv
+import functools
 import logging
 import sys, os
 import subprocess
 from tqdm import tqdm
-import pandas as pd
 import glob
 import concurrent.futures
 
-def process_file(filename):
-    col_names =  ['users', 'subreddit']
-    reddit_df  = pd.DataFrame(columns = col_names)
-    row_idx = 0
+def output_path(filename, save_path):
+    return save_path + filename.split('/')[-1] + '.csv'
+
+def process_file(filename, save_path, chunk_lines=100000):
+    ''' Stream the comments of one split file and write their (author,
+    subreddit) pairs to csv, chunk_lines rows at a time. Rows go to a .tmp
+    file that is renamed once the split is done, so an existing .csv is
+    always complete and is skipped when a crashed run is resumed '''
     file_prefix = filename.split('/')[-1]
-    save_path = "./reddit_data/Reddit_split_2017-11/split_csv/" + \
-            file_prefix + '.csv'
-    for line in open(filename, 'r'):
-        loaded_json = json.loads(line)
-        user = loaded_json["author"]
-        subreddit = loaded_json["subreddit"]
-        reddit_df.loc[row_idx] = [user,subreddit]
-        row_idx +=1
-    reddit_df.to_csv(save_path)
+    out_path = output_path(filename, save_path)
+    if os.path.exists(out_path):
+        print("Skipping %s, already processed" %(file_prefix))
+        return file_prefix
+
+    with open(out_path + '.tmp', 'w', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        writer.writerow(['users', 'subreddit'])
+        chunk = []
+        for line in open(filename, 'r', encoding='utf-8'):
+            loaded_json = json.loads(line)
+            chunk.append((loaded_json["author"], loaded_json["subreddit"]))
+            if len(chunk) == chunk_lines:
+                writer.writerows(chunk)
+                chunk = []
+        writer.writerows(chunk)
+    os.rename(out_path + '.tmp', out_path)
     print("Finished Processing %s" %(file_prefix))
     return file_prefix
 
@@ -34,6 +47,8 @@ def parse_args():
             default='Split_RC_2017-11*', help='Split Prefix Reddit dump')
     parser.add_argument('--save_dir_prefix', type=str,\
             default='split_csv/', help="output path")
+    parser.add_argument('--chunk_lines', type=int, default=100000,\
+            help='Rows buffered before each csv write (default: 100000)')
     args = parser.parse_args()
     args.save_path = args.filedir + args.save_dir_prefix
     return args
@@ -41,8 +56,15 @@ def parse_args():
 def main(args):
     file_paths = args.filedir + args.fileprefix
     split_files = glob.glob(file_paths)
+    if not os.path.exists(args.save_path):
+        os.makedirs(args.save_path)
+    done = [f for f in split_files if os.path.exists(output_path(f, args.save_path))]
+    split_files = [f for f in split_files if f not in done]
+    print("Resuming: %d split files already processed, %d to go" %(len(done), len(split_files)))
+    process = functools.partial(process_file, save_path=args.save_path,\
+            chunk_lines=args.chunk_lines)
     with concurrent.futures.ProcessPoolExecutor() as executor:
-        for file_, saved_file in tqdm(zip(split_files,executor.map(process_file,split_files)),total=len(split_files)):
+        for file_, saved_file in tqdm(zip(split_files,executor.map(process,split_files)),total=len(split_files)):
             print("Split file %s was saved as %s" %(file_,saved_file))
 
 if __name__ == '__main__':
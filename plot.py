@@ -1,4 +1,3 @@
-import joblib
 import numpy as np
 import argparse
 import os
@@ -6,6 +5,7 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import ipdb
+from results_store import ResultsStore
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -13,38 +13,13 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', type=str, default='FB15k', help='Knowledge base version (default: FB15k)')
     args = parser.parse_args()
     outname_base = os.path.join(args.save_dir, 'FairD_[36]_{}'.format(args.dataset))
-    epochs = np.arange(20,1000,20)
+    results = ResultsStore(outname_base + '_results')
 
-    mrr_list = []
-    h10_list = []
-    h5_list = []
-    mean_rank = []
-
-    for epoch in epochs:
-        fn = outname_base+'epoch{}_validation_ranks.pkl'.format(epoch)
-        f_ = joblib.load(fn)
-        l_ranks = f_['l_ranks']
-        r_ranks = f_['r_ranks']
-
-        ''' Calculate Stats '''
-        l_mean = l_ranks.mean()
-        r_mean = r_ranks.mean()
-        l_mrr = (1. / l_ranks).mean()
-        r_mrr = (1. / r_ranks).mean()
-        l_h10 = (l_ranks <= 10).mean()
-        r_h10 = (r_ranks <= 10).mean()
-        l_h5 = (l_ranks <= 5).mean()
-        r_h5 = (r_ranks <= 5).mean()
-
-        avg_mr = (l_mean + r_mean)/2
-        avg_mrr = (l_mrr+r_mrr)/2
-        avg_h10 = (l_h10+r_h10)/2
-        avg_h5 = (l_h5+r_h5)/2
-
-        mean_rank.append(avg_mr)
-        mrr_list.append(avg_mrr)
-        h10_list.append(avg_h10)
-        h5_list.append(avg_h5)
+    ''' Only the metric columns of the index are read, never the ranks '''
+    epochs, mean_rank = results.metric('mr')
+    _, mrr_list = results.metric('mrr')
+    _, h10_list = results.metric('h10')
+    _, h5_list = results.metric('h5')
 
     ''' Plots '''
     f, (ax1, ax2) = plt.subplots(1, 2, sharex=True)
@@ -1,76 +1,168 @@
+import os
 import numpy as np
 import pandas as pd
 import ipdb
 
-def make_dataset(load_sidechannel=False):
+ML_100K_DIR = './ml-100k'
+ML_1M_DIR = './ml-1m'
+CACHE_VERSION = 1
+COLUMNS_TITLES = ['user_id', 'rating', 'movie_id']
+
+def _source_key(paths):
+    ''' Cache format version plus the size and mtime of every source file '''
+    key = [CACHE_VERSION]
+    for path in paths:
+        stat = os.stat(path)
+        key += [stat.st_size, int(stat.st_mtime)]
+    return np.array(key, dtype=np.int64)
+
+def _save_npz(cache_fn, **arrays):
+    cache_dir = os.path.dirname(cache_fn)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_fn + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(cache_fn + '.tmp', cache_fn)
+
+def cached_columns(cache_fn, sources, parse):
+    ''' Typed column arrays returned by parse(), stored once in cache_fn and
+    reloaded from it while the source files keep their size and mtime '''
+    key = _source_key(sources)
+    if os.path.exists(cache_fn):
+        cache = np.load(cache_fn)
+        if np.array_equal(cache['_key'], key):
+            return {name: cache[name] for name in cache.files if name != '_key'}
+    columns = parse()
+    _save_npz(cache_fn, _key=key, **columns)
+    return columns
+
+def cached_split(cache_fn, num_rows, seed, cutoff):
+    ''' Train and test row indices of a seeded permutation of num_rows rows,
+    cut at cutoff and cached per seed '''
+    key = np.array([CACHE_VERSION, num_rows, seed, int(np.round(cutoff * 1e6))])
+    if os.path.exists(cache_fn):
+        cache = np.load(cache_fn)
+        if np.array_equal(cache['_key'], key):
+            return cache['train'], cache['test']
+    perm = np.random.RandomState(seed).permutation(num_rows).astype(np.int64)
+    cutoff_row = int(np.round(num_rows * cutoff))
+    train, test = perm[:cutoff_row], perm[cutoff_row:]
+    _save_npz(cache_fn, _key=key, train=train, test=test)
+    return train, test
+
+def _ratings_columns(frame):
+    ''' 0-based int64 user and movie ids and 0-4 ratings; timestamps are
+    never read '''
+    return {'user_id': frame['user_id'].values.astype(np.int64) - 1,
+            'rating': frame['rating'].values.astype(np.int64) - 1,
+            'movie_id': frame['movie_id'].values.astype(np.int64) - 1}
+
+def _ratings_frame(columns, rows=None):
+    frame = pd.DataFrame({name: columns[name] for name in COLUMNS_TITLES},\
+            columns=COLUMNS_TITLES)
+    if rows is not None:
+        frame = frame.iloc[rows].reset_index(drop=True)
+    return frame
+
+def ratings_matrix(ratings, num_movies, num_users):
+    ''' movie x user scipy.sparse CSR matrix of 1-5 ratings, built on demand
+    from ratings with 0-based ids. Cells without a rating stay implicit
+    instead of the zero-filled dense pivot tables this replaces '''
+    from scipy import sparse
+    values = np.asarray(ratings['rating']) + 1
+    return sparse.csr_matrix((values, (np.asarray(ratings['movie_id']),\
+            np.asarray(ratings['user_id']))), shape=(num_movies, num_users))
+
+def parse_100k_ratings(path):
     r_cols = ['user_id', 'movie_id', 'rating', 'unix_timestamp']
-    train_ratings = pd.read_csv('./ml-100k/u1.base', sep='\t', names=r_cols,
-			  encoding='latin-1')
-    test_ratings = pd.read_csv('./ml-100k/u1.test', sep='\t', names=r_cols,
-			  encoding='latin-1')
-    if load_sidechannel:
-        u_cols = ['user_id', 'age', 'sex', 'occupation', 'zip_code']
-        users = pd.read_csv('./ml-100k/u.user', sep='|', names=u_cols,
-                            encoding='latin-1', parse_dates=True)
-        bins = np.linspace(5, 75, num=15, endpoint=True)
-        inds = np.digitize(users['age'].values, bins)
-        m_cols = ['movie_id', 'title', 'release_date', 'video_release_date', 'imdb_url']
-        movies = pd.read_csv('./ml-100k/u.item', sep='|', names=m_cols, usecols=range(5),
-                             encoding='latin-1')
-        movie_ratings = pd.merge(movies, train_ratings)
-        df = pd.merge(movie_ratings, users)
-        df.drop(df.columns[[3,4,7]], axis=1, inplace=True)
-        movies.drop(movies.columns[[3,4]], inplace = True, axis = 1 )
-
-    train_ratings.drop( "unix_timestamp", inplace = True, axis = 1 )
-    train_ratings_matrix = train_ratings.pivot_table(index=['movie_id'],\
-            columns=['user_id'],values='rating').reset_index(drop=True)
-    train_ratings_matrix.fillna( 0, inplace = True )
-    test_ratings.drop( "unix_timestamp", inplace = True, axis = 1 )
-    test_ratings_matrix = test_ratings.pivot_table(index=['movie_id'],\
-            columns=['user_id'],values='rating').reset_index(drop=True)
-    test_ratings_matrix.fillna( 0, inplace = True )
-    train_ratings_matrix.head()
-    columnsTitles=["user_id","rating","movie_id"]
-    train_ratings=train_ratings.reindex(columns=columnsTitles)-1
-    test_ratings=test_ratings.reindex(columns=columnsTitles)-1
-    users['user_id'] = users['user_id'] - 1
-    movies['movie_id'] = movies['movie_id'] - 1
+    frame = pd.read_csv(path, sep='\t', names=r_cols, usecols=r_cols[:3],\
+            dtype=np.int64, encoding='latin-1')
+    return _ratings_columns(frame)
+
+def parse_100k_users(path):
+    u_cols = ['user_id', 'age', 'sex', 'occupation', 'zip_code']
+    users = pd.read_csv(path, sep='|', names=u_cols, dtype=str,\
+            encoding='latin-1')
+    return {'user_id': users['user_id'].values.astype(np.int64) - 1,
+            'age': users['age'].values.astype(np.int64),
+            'sex': users['sex'].values.astype(str),
+            'occupation': users['occupation'].values.astype(str),
+            'zip_code': users['zip_code'].values.astype(str)}
 
+def parse_100k_movies(path):
+    m_cols = ['movie_id', 'title', 'release_date']
+    movies = pd.read_csv(path, sep='|', names=m_cols, usecols=range(3),\
+            dtype=str, encoding='latin-1').fillna('')
+    return {'movie_id': movies['movie_id'].values.astype(np.int64) - 1,
+            'title': movies['title'].values.astype(str),
+            'release_date': movies['release_date'].values.astype(str)}
+
+def parse_1M_ratings(path):
+    ''' ratings.dat is all integers, so '::' is read as ':' by the C parser
+    with the empty fields in between skipped '''
+    r_cols = ['user_id', 'movie_id', 'rating']
+    frame = pd.read_csv(path, sep=':', header=None, usecols=[0, 2, 4],\
+            names=r_cols, dtype=np.int64, engine='c')
+    return _ratings_columns(frame)
+
+def parse_1M_users(path):
+    u_cols = ['user_id', 'sex', 'age', 'occupation', 'zip_code']
+    users = pd.read_csv(path, sep=':', header=None, usecols=[0, 2, 4, 6, 8],\
+            names=u_cols, dtype=str, engine='c', encoding='latin-1')
+    return {'user_id': users['user_id'].values.astype(np.int64) - 1,
+            'sex': users['sex'].values.astype(str),
+            'age': users['age'].values.astype(np.int64),
+            'occupation': users['occupation'].values.astype(np.int64),
+            'zip_code': users['zip_code'].values.astype(str)}
+
+def parse_1M_movies(path):
+    ''' Titles may contain ':', so movies.dat is split on '::' line by line '''
+    with open(path, encoding='latin-1') as f:
+        rows = [line.rstrip('\n').split('::') for line in f if line.strip()]
+    return {'movie_id': np.array([int(r[0]) for r in rows], dtype=np.int64) - 1,
+            'title': np.array([r[1] for r in rows]).astype(str),
+            'genre': np.array([r[2] for r in rows]).astype(str)}
+
+def load_columns(data_dir, name, parse):
+    ''' Columns of data_dir/name, parsed once into data_dir/cache '''
+    path = os.path.join(data_dir, name)
+    cache_fn = os.path.join(data_dir, 'cache', name.replace('.', '_') + '.npz')
+    return cached_columns(cache_fn, [path], lambda: parse(path))
+
+def split_users(user_ids, seed, cutoff, data_dir):
+    ''' Seeded train/test split of the user ids, cached per seed '''
+    user_ids = np.unique(user_ids)
+    cache_fn = os.path.join(data_dir, 'cache', 'users_split_seed%d.npz' % seed)
+    train, test = cached_split(cache_fn, len(user_ids), seed, cutoff)
+    return user_ids[train], user_ids[test]
+
+def make_dataset(load_sidechannel=False, data_dir=ML_100K_DIR):
+    ''' The u1 train/test split of MovieLens 100k as [user_id, rating,
+    movie_id] frames, read from cached typed columns '''
+    train_ratings = _ratings_frame(load_columns(data_dir, 'u1.base', parse_100k_ratings))
+    test_ratings = _ratings_frame(load_columns(data_dir, 'u1.test', parse_100k_ratings))
     if load_sidechannel:
+        users = pd.DataFrame(load_columns(data_dir, 'u.user', parse_100k_users),\
+                columns=['user_id', 'age', 'sex', 'occupation', 'zip_code'])
+        movies = pd.DataFrame(load_columns(data_dir, 'u.item', parse_100k_movies),\
+                columns=['movie_id', 'title', 'release_date'])
         return train_ratings,test_ratings,users,movies
     else:
         return train_ratings,test_ratings
 
-def make_dataset_1M(load_sidechannel=False):
-    r_cols = ['user_id', 'movie_id', 'rating', 'unix_timestamp']
-    ratings = pd.read_csv('./ml-1m/ratings.dat', sep='::', names=r_cols,
-			  encoding='latin-1')
-    shuffled_ratings = ratings.sample(frac=1).reset_index(drop=True)
-    train_cutoff_row = int(np.round(len(shuffled_ratings)*0.9))
-    train_ratings = shuffled_ratings[:train_cutoff_row]
-    test_ratings = shuffled_ratings[train_cutoff_row:]
-    if load_sidechannel:
-        u_cols = ['user_id','sex','age','occupation','zip_code']
-        m_cols = ['movie_id','title','genre']
-        users = pd.read_csv('./ml-1m/users.dat', sep='::', names=u_cols,
-                            encoding='latin-1', parse_dates=True)
-        movies = pd.read_csv('./ml-1m/movies.dat', sep='::', names=m_cols,
-                            encoding='latin-1', parse_dates=True)
-
-    train_ratings.drop( "unix_timestamp", inplace = True, axis = 1 )
-    train_ratings_matrix = train_ratings.pivot_table(index=['movie_id'],\
-            columns=['user_id'],values='rating').reset_index(drop=True)
-    test_ratings.drop( "unix_timestamp", inplace = True, axis = 1 )
-    columnsTitles=["user_id","rating","movie_id"]
-    train_ratings=train_ratings.reindex(columns=columnsTitles)-1
-    test_ratings=test_ratings.reindex(columns=columnsTitles)-1
-    users.user_id = users.user_id.astype(np.int64)
-    movies.movie_id = movies.movie_id.astype(np.int64)
-    users['user_id'] = users['user_id'] - 1
-    movies['movie_id'] = movies['movie_id'] - 1
-
+def make_dataset_1M(load_sidechannel=False, seed=0, data_dir=ML_1M_DIR):
+    ''' MovieLens 1M as [user_id, rating, movie_id] frames, with the 90/10
+    split of the ratings drawn from `seed` and cached per seed '''
+    ratings = load_columns(data_dir, 'ratings.dat', parse_1M_ratings)
+    cache_fn = os.path.join(data_dir, 'cache', 'ratings_split_seed%d.npz' % seed)
+    train_rows, test_rows = cached_split(cache_fn, len(ratings['user_id']), seed, 0.9)
+    train_ratings = _ratings_frame(ratings, train_rows)
+    test_ratings = _ratings_frame(ratings, test_rows)
     if load_sidechannel:
+        users = pd.DataFrame(load_columns(data_dir, 'users.dat', parse_1M_users),\
+                columns=['user_id', 'sex', 'age', 'occupation', 'zip_code'])
+        movies = pd.DataFrame(load_columns(data_dir, 'movies.dat', parse_1M_movies),\
+                columns=['movie_id', 'title', 'genre'])
         return train_ratings,test_ratings,users,movies
     else:
         return train_ratings,test_ratings
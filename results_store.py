@@ -0,0 +1,85 @@
+import numpy as np
+import os
+
+INDEX_DTYPE = np.dtype([('epoch', '<i8'), ('offset', '<i8'), ('count', '<i8'),\
+        ('mr', '<f8'), ('mrr', '<f8'), ('h10', '<f8'), ('h5', '<f8')])
+RANK_DTYPE = np.dtype('<f4')
+
+def rank_metrics(l_ranks, r_ranks):
+    ''' MR, MRR, Hits@10 and Hits@5 averaged over lhs and rhs ranks '''
+    return {'mr': (l_ranks.mean() + r_ranks.mean())/2,\
+            'mrr': ((1. / l_ranks).mean() + (1. / r_ranks).mean())/2,\
+            'h10': ((l_ranks <= 10).mean() + (r_ranks <= 10).mean())/2,\
+            'h5': ((l_ranks <= 5).mean() + (r_ranks <= 5).mean())/2}
+
+class ResultsStore(object):
+    ''' Append-only store of validation ranks for one run. l_ranks and
+    r_ranks are raw float32 columns; index.bin holds one fixed-size record
+    per epoch with its slice of the rank columns and derived metrics. The
+    index record is written last, so a crash mid-append leaves only a
+    tail that readers never see and the next append truncates. The
+    directory is created by the first append or reset; reading a store
+    that was never written raises FileNotFoundError '''
+    def __init__(self, path):
+        self.path = path
+        self.index_fn = os.path.join(path, 'index.bin')
+        self.l_fn = os.path.join(path, 'l_ranks.bin')
+        self.r_fn = os.path.join(path, 'r_ranks.bin')
+
+    def reset(self):
+        ''' Drop every record, so a fresh run does not append its epochs
+        after those of an earlier run with the same name '''
+        self._makedirs()
+        for fn in (self.index_fn, self.l_fn, self.r_fn):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def _makedirs(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def index(self):
+        if not os.path.isdir(self.path):
+            raise FileNotFoundError("no results store at %s" % self.path)
+        if not os.path.exists(self.index_fn):
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        index = np.fromfile(self.index_fn, dtype=np.uint8)
+        usable = len(index) - len(index) % INDEX_DTYPE.itemsize
+        return index[:usable].view(INDEX_DTYPE)
+
+    def append(self, epoch, l_ranks, r_ranks):
+        self._makedirs()
+        index = self.index()
+        offset = 0
+        if len(index):
+            offset = int(index['offset'][-1] + index['count'][-1])
+        with open(self.index_fn, 'ab') as f:
+            f.truncate(len(index) * INDEX_DTYPE.itemsize)
+
+        for fn, ranks in ((self.l_fn, l_ranks), (self.r_fn, r_ranks)):
+            with open(fn, 'ab') as f:
+                f.truncate(offset * RANK_DTYPE.itemsize)
+                f.write(np.ascontiguousarray(ranks, dtype=RANK_DTYPE).tobytes())
+
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record['epoch'], record['offset'], record['count'] = epoch, offset, len(l_ranks)
+        for name, value in rank_metrics(np.asarray(l_ranks), np.asarray(r_ranks)).items():
+            record[name] = value
+        with open(self.index_fn, 'ab') as f:
+            f.write(record.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def metric(self, name):
+        ''' (epochs, values) of one index column, e.g. 'mrr' '''
+        index = self.index()
+        return index['epoch'], index[name]
+
+    def ranks(self, epoch):
+        ''' Memory-mapped (l_ranks, r_ranks) of the latest record for epoch '''
+        index = self.index()
+        rec = index[np.nonzero(index['epoch'] == epoch)[0][-1]]
+        start, stop = rec['offset'], rec['offset'] + rec['count']
+        l_ranks = np.memmap(self.l_fn, dtype=RANK_DTYPE, mode='r')[start:stop]
+        r_ranks = np.memmap(self.r_fn, dtype=RANK_DTYPE, mode='r')[start:stop]
+        return l_ranks, r_ranks
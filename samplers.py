@@ -0,0 +1,289 @@
+import torch
+import numpy as np
+import time
+from utils import _as_triplets
+from eval_kb import chunk_size_for
+
+class BernoulliSampler(object):
+    ''' Drop-in for corrupt_batch that corrupts the head of (h, r, t) with
+    probability tph / (tph + hpt) of its relation and the tail otherwise
+    (Wang et al., 2014), so 1-to-N relations mostly get their head replaced.
+    tph/hpt are the mean tails per head and heads per tail of each relation
+    in the training triplets '''
+    def __init__(self, triplets, num_ent, num_rel):
+        triplets = torch.from_numpy(_as_triplets(triplets))
+        lhs, rel, rhs = triplets[:, 0], triplets[:, 1], triplets[:, 2]
+        num_triplets = torch.bincount(rel, minlength=num_rel).double()
+        num_heads = torch.bincount(torch.unique(rel*num_ent + lhs) // num_ent,\
+                minlength=num_rel).double()
+        num_tails = torch.bincount(torch.unique(rel*num_ent + rhs) // num_ent,\
+                minlength=num_rel).double()
+
+        tph = num_triplets / num_heads.clamp(min=1)
+        hpt = num_triplets / num_tails.clamp(min=1)
+        head_prob = tph / (tph + hpt)
+        ''' Relations unseen in training fall back to the uniform split '''
+        head_prob[num_triplets == 0] = 0.5
+        self.head_prob = head_prob.float()
+
+    def __call__(self, batch, num_ent, return_side=False):
+        ''' With return_side, also returns the boolean mask of rows whose
+        head (rather than tail) was replaced '''
+        if self.head_prob.device != batch.device:
+            self.head_prob = self.head_prob.to(batch.device)
+        probs = self.head_prob[batch[:, 1]]
+        corrupt_head = torch.rand(len(batch), device=batch.device) < probs
+        q_samples = torch.randint(0, num_ent, (len(batch),), dtype=torch.long,\
+                device=batch.device)
+
+        corrupted = batch.clone()
+        corrupted[:, 0] = torch.where(corrupt_head, q_samples, batch[:, 0])
+        corrupted[:, 2] = torch.where(corrupt_head, batch[:, 2], q_samples)
+        if return_side:
+            return corrupted, q_samples, corrupt_head
+        return corrupted, q_samples
+
+class SharedNegatives(object):
+    ''' Negatives shared across the batch: rather than num_nce fresh
+    corruptions per positive, every positive is scored against one pool
+    of P candidates per corrupted column, giving a (B, P) energy matrix.
+    pool_size=0 reuses the entities already at that column of the batch
+    (P = B), pool_size > 0 draws P uniform ids from that column's
+    vocabulary. As in corrupt_batch, the first half of the batch has
+    cols[0] replaced and the rest cols[1]. P is capped so that the (B, P)
+    step stays within `max_mb` megabytes '''
+    # energies, their gradient, weights, packed keys and GEMM temporaries
+    BYTES_PER_CELL = 32
+
+    def __init__(self, pool_size, cols, sizes, max_mb=1024):
+        self.pool_size = pool_size
+        self.cols = cols
+        self.sizes = sizes
+        self.max_mb = max_mb
+        self.warned = False
+
+    def pool_len(self, batch_size):
+        ''' Pool size used for a batch of batch_size positives '''
+        wanted = batch_size if self.pool_size == 0 else self.pool_size
+        cap = int(self.max_mb * 2**20 // (self.BYTES_PER_CELL * max(batch_size, 1)))
+        if cap < 1:
+            raise ValueError("A batch of %d positives does not fit a shared "\
+                    "negative pool in %d MB" % (batch_size, self.max_mb))
+        if wanted > cap and not self.warned:
+            print("Shared negative pool capped from %d to %d for batches of %d "\
+                    "(%d MB)" % (wanted, cap, batch_size, self.max_mb))
+            self.warned = True
+        return min(wanted, cap)
+
+    def __call__(self, batch, known=None):
+        ''' Returns the per-column pools and (B, P) weights that drop
+        candidates equal to their own positive and, with `known` (a
+        PackedKeys of training rows), corruptions that are known rows.
+        Those are tested as packed keys, without building the rows '''
+        half = len(batch)//2
+        num = self.pool_len(len(batch))
+        if self.pool_size == 0:
+            pools = [batch[:num, col] for col in self.cols]
+        else:
+            pools = [torch.randint(0, size, (num,), dtype=torch.long,\
+                    device=batch.device) for size in self.sizes]
+
+        weights = []
+        for rows, col, pool in zip((batch[:half], batch[half:]), self.cols, pools):
+            fixed = rows[:, col].unsqueeze(1)
+            keep = pool.unsqueeze(0) != fixed
+            if known is not None:
+                stride = known.stride(col)
+                keys = (known.pack(rows) - fixed.view(-1) * stride).unsqueeze(1)\
+                        + pool.unsqueeze(0) * stride
+                keep = keep & ~known.contains_keys(keys).to(keep.device)
+            weights.append(keep.float())
+        return pools, torch.cat(weights)
+
+    def score(self, modelD, batch, pools, filters=None):
+        ''' (B, P) energies. Models with pool_energies score each half as
+        a norm expansion over GEMMs; otherwise score_candidates is swept
+        over the pool in chunks, so no (B, P, embed_dim) tensor is built '''
+        half = len(batch)//2
+        pools = [pool.to(batch.device) for pool in pools]
+        return torch.cat([self._score_half(modelD, rows, col, pool, filters)\
+                for rows, col, pool in zip((batch[:half], batch[half:]),\
+                self.cols, pools)])
+
+    def _score_half(self, modelD, rows, col, pool, filters):
+        if hasattr(modelD, 'pool_energies'):
+            enrgs = modelD.pool_energies(rows, col, pool, filters=filters)
+            if enrgs is not None:
+                return enrgs
+        per_cand = max(len(rows), 1) * (2 * modelD.embed_dim + 1) * 4
+        chunk = max(1, int(self.max_mb * 2**20 // per_cand))
+        return torch.cat([modelD.score_candidates(rows, col, filters=filters,\
+                ents=pool[start:start+chunk]) for start in range(0, len(pool), chunk)],\
+                dim=1)
+
+class HardNegativeCache(object):
+    ''' Wraps a uniform sampler (corrupt_batch or BernoulliSampler) and
+    swaps a `hard_frac` share of its corruptions for cached hard negatives:
+    for every training (h, r) and (r, t), the `num_hard` lowest-energy
+    candidates that are not known training triplets. The queries are the
+    CSR keys of `known`, a KnownTriples over the training split. Until the
+    first refresh, batches pass through the base sampler unchanged. A query
+    with fewer than num_hard unknown candidates keeps its uniform corruption
+    for the missing slots '''
+    def __init__(self, base, known, num_hard, hard_frac=0.5):
+        self.base = base
+        self.known = known
+        self.num_hard = num_hard
+        self.hard_frac = hard_frac
+        num_ent, num_rel = known.num_ent, known.num_rel
+
+        hr_keys = known.hr_keys.astype(np.int64)
+        rt_keys = known.rt_keys.astype(np.int64)
+        ''' Candidates replace the tail of (h, r, .) and the head of (., r, t) '''
+        self.queries = {\
+                2: np.stack([hr_keys // num_rel, hr_keys % num_rel,\
+                    np.zeros_like(hr_keys)], axis=1),\
+                0: np.stack([np.zeros_like(rt_keys), rt_keys // num_ent,\
+                    rt_keys % num_ent], axis=1)}
+        self.keys = {2: torch.from_numpy(hr_keys), 0: torch.from_numpy(rt_keys)}
+        self.cands, self.valid = None, None
+
+    def _top_candidates(self, modelD, queries, side, batch_size, chunk_size,\
+            device, filters=None):
+        ''' (Q, num_hard) lowest-energy unknown candidates for column `side`,
+        keeping only a running top-k while the entity table is swept, and
+        the number of them that are not masked known entities '''
+        top, valid = [], []
+        for start in range(0, len(queries), batch_size):
+            q = queries[start:start+batch_size]
+            batch = torch.from_numpy(q).to(device)
+            best_e = torch.zeros(len(q), 0, device=device)
+            best_i = torch.zeros(len(q), 0, dtype=torch.long, device=device)
+            spans = self.known.known_spans(q, side, device=device)
+            for c_start in range(0, modelD.num_ent, chunk_size):
+                c_stop = min(c_start + chunk_size, modelD.num_ent)
+                ents = torch.arange(c_start, c_stop, dtype=torch.long, device=device)
+                enrgs = modelD.score_candidates(batch, side, filters=filters, ents=ents)
+                enrgs[self.known.filter_mask(q, side, device=device,\
+                        start=c_start, stop=c_stop, spans=spans)] = float('inf')
+                best_e = torch.cat([best_e, enrgs], dim=1)
+                best_i = torch.cat([best_i, ents.expand(len(q), -1)], dim=1)
+                k = min(self.num_hard, best_e.size(1))
+                best_e, pos = best_e.topk(k, dim=1, largest=False)
+                best_i = best_i.gather(1, pos)
+            top.append(best_i)
+            valid.append(torch.isfinite(best_e).sum(dim=1))
+        return torch.cat(top), torch.cat(valid)
+
+    def refresh(self, modelD, batch_size=64, mem_budget=512, use_cuda=False,\
+            filters=None):
+        ''' Rebuild the cache from the current model with the same chunked
+        sweep as ranking. Keys and candidates stay on the sweep device (see
+        move). Returns the wall time spent, in seconds '''
+        start_time = time.time()
+        device = 'cuda' if use_cuda else 'cpu'
+        chunk_size = chunk_size_for(modelD, batch_size, mem_budget)
+        with torch.no_grad():
+            top = {side: self._top_candidates(modelD, queries, side,\
+                    batch_size, chunk_size, device, filters=filters)\
+                    for side, queries in self.queries.items()}
+        self.cands = {side: cands for side, (cands, _) in top.items()}
+        self.valid = {side: valid for side, (_, valid) in top.items()}
+        self.move(device)
+        return time.time() - start_time
+
+    def move(self, device):
+        ''' Keep the tables where training batches live, so that lookups
+        run on that device without syncing with the host '''
+        self.keys = {side: keys.to(device) for side, keys in self.keys.items()}
+        self.cands = {side: cands.to(device) for side, cands in self.cands.items()}
+        self.valid = {side: valid.to(device) for side, valid in self.valid.items()}
+
+    def lookup(self, batch, side):
+        ''' One random cached slot for column `side` of each row, and whether
+        that slot holds an unknown candidate '''
+        if side == 0:
+            keys = batch[:, 1]*self.known.num_ent + batch[:, 2]
+        else:
+            keys = batch[:, 0]*self.known.num_rel + batch[:, 1]
+        pos = torch.searchsorted(self.keys[side], keys)
+        pos = pos.clamp(max=len(self.keys[side]) - 1)
+        cands = self.cands[side]
+        pick = torch.randint(0, cands.size(1), (len(batch),), dtype=torch.long,\
+                device=batch.device)
+        return cands[pos, pick], pick < self.valid[side][pos]
+
+    def __call__(self, batch, num_ent):
+        corrupted, q_samples, head = self.base(batch, num_ent, return_side=True)
+        if self.cands is None:
+            return corrupted, q_samples
+        if self.keys[0].device != batch.device:
+            self.move(batch.device)
+
+        hard = torch.rand(len(batch), device=batch.device) < self.hard_frac
+        head_cands, head_ok = self.lookup(batch, 0)
+        tail_cands, tail_ok = self.lookup(batch, 2)
+        hard = hard & torch.where(head, head_ok, tail_ok)
+        corrupted[:, 0] = torch.where(hard & head, head_cands, corrupted[:, 0])
+        corrupted[:, 2] = torch.where(hard & ~head, tail_cands, corrupted[:, 2])
+        q_samples = torch.where(hard, torch.where(head, head_cands, tail_cands), q_samples)
+        return corrupted, q_samples
+
+class UniformSampler(object):
+    ''' corrupt_batch as an object: the first half of the batch gets column
+    cols[0] replaced by a uniform id, the rest cols[1]. Draws come from one
+    torch.Generator per device, and the corrupted rows, the samples and the
+    side mask are written into output buffers kept per (device, batch
+    shape), so a step allocates nothing and does not assume CUDA. Without a
+    `seed`, each generator is seeded from the global torch RNG and follows
+    torch.manual_seed; with one, DataLoader workers offset it by their id '''
+    def __init__(self, seed=None, cols=(0, 2)):
+        self.seed = seed
+        self.cols = cols
+        self.generators = {}
+        self.buffers = {}
+
+    def __getstate__(self):
+        ''' Generators and buffers are rebuilt lazily in the new process '''
+        return {'seed': self.seed, 'cols': self.cols, 'generators': {}, 'buffers': {}}
+
+    def generator(self, device):
+        if device not in self.generators:
+            if self.seed is None:
+                seed = int(torch.randint(0, 2**62, (1,)))
+            else:
+                worker = torch.utils.data.get_worker_info()
+                seed = self.seed + (0 if worker is None else worker.id + 1)
+            self.generators[device] = torch.Generator(device=device).manual_seed(seed)
+        return self.generators[device]
+
+    def output(self, batch):
+        key = (batch.device, tuple(batch.shape), batch.dtype)
+        if key not in self.buffers:
+            batch_size = len(batch)
+            self.buffers[key] = (torch.empty_like(batch),\
+                    torch.empty(batch_size, dtype=torch.long, device=batch.device),\
+                    torch.arange(batch_size, device=batch.device) < batch_size//2)
+        return self.buffers[key]
+
+    def __call__(self, batch, *sizes, return_side=False):
+        ''' `sizes` is the vocabulary of both columns, or one per column.
+        With return_side, also returns the boolean mask of rows whose
+        cols[0] was replaced. Every returned tensor is a reused output
+        buffer: it is overwritten by the next call with a batch of the same
+        device and shape, so callers must copy anything they keep past
+        the current step '''
+        if len(sizes) == 1:
+            sizes = sizes * 2
+        half = len(batch)//2
+        corrupted, q_samples, side = self.output(batch)
+        gen = self.generator(batch.device)
+        q_samples[:half].random_(0, sizes[0], generator=gen)
+        q_samples[half:].random_(0, sizes[1], generator=gen)
+
+        corrupted.copy_(batch)
+        corrupted[:half, self.cols[0]] = q_samples[:half]
+        corrupted[half:, self.cols[1]] = q_samples[half:]
+        if return_side:
+            return corrupted, q_samples, side
+        return corrupted, q_samples
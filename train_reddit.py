@@ -21,6 +21,7 @@ import subprocess
 from tqdm import tqdm
 tqdm.monitor_interval = 0
 from utils import create_or_append, compute_rank
+from samplers import UniformSampler
 import joblib
 from collections import Counter
 import ipdb
@@ -36,30 +37,23 @@ class MarginRankingLoss(nn.Module):
         self.num_nce = num_nce
 
     def forward(self, p_enrgs, n_enrgs, weights=None):
-        scores = (self.margin + p_enrgs.repeat(self.num_nce) - n_enrgs).clamp(min=0)
+        ''' n_enrgs holds num_nce blocks of negatives, block k corrupting
+        every positive once, and is scored as a (B, num_nce) matrix. Shared
+        negatives arrive already as a (B, P) matrix '''
+        if n_enrgs.dim() == 1:
+            n_enrgs = n_enrgs.view(self.num_nce, -1).t()
+        scores = (self.margin + p_enrgs.unsqueeze(1) - n_enrgs).clamp(min=0)
 
         if weights is not None:
+            if weights.dim() == 1:
+                weights = weights.view(self.num_nce, -1).t()
             scores = scores * weights / weights.mean()
         return scores.mean(), scores
 
+_reddit_sampler = UniformSampler(cols=(0, 1))
 def corrupt_reddit_batch(batch, num_users, num_sr):
     # batch: ltensor type, contains positive triplets
-    batch_size, _ = batch.size()
-    corrupted = batch.clone()
-    _cb_var_user = []
-    _cb_var_sr = []
-
-    if len(_cb_var_user) == 0 and len(_cb_var_sr) == 0:
-        _cb_var_user.append(torch.LongTensor(batch_size//2).cuda())
-        _cb_var_sr.append(torch.LongTensor(batch_size//2).cuda())
-
-    q_samples_user = _cb_var_user[0].random_(0, num_users)
-    q_samples_sr = _cb_var_sr[0].random_(0, num_sr)
-
-    corrupted[:batch_size//2, 0] = q_samples_user
-    corrupted[batch_size//2:, 1] = q_samples_sr
-
-    return corrupted.contiguous()
+    return _reddit_sampler(batch, num_users, num_sr)[0]
 
 def mask_fairDiscriminators(discriminators, mask):
     # compress('ABCDEF', [1,0,1,0,1,1]) --> A C E F
@@ -86,24 +80,30 @@ def train_reddit_nce(data_loader,train_hash,counter,args,modelD,optimizerD,\
             masked_optimizer_fairD_set = optimizer_fairD_set
             masked_filter_set = filter_set
 
-        nce_list = []
-        for i in range(0,args.num_nce):
-            nce_batch = corrupt_reddit_batch(p_batch,args.num_users,args.num_sr)
+        if args.shared_negs is not None:
+            ''' One pool of users and one of subreddits, scored against every
+            edge. False negatives are dropped from the (B, P) weights directly '''
+            pools, nce_weights = args.shared_negs(p_batch,\
+                    train_hash if args.filter_false_negs else None)
+            nce_batch = p_batch[:0]
+        else:
+            ''' All num_nce corruptions of the batch are drawn in one call '''
+            nce_batch = corrupt_reddit_batch(p_batch.repeat(args.num_nce, 1),\
+                    args.num_users,args.num_sr)
+            nce_weights = torch.ones(len(nce_batch))
             if args.filter_false_negs:
-                nce_falseNs = torch.FloatTensor(np.array([int(x.tobytes() in train_hash)\
-                        for x in nce_batch.numpy()], dtype=np.float32))
-                nce_falseNs = Variable(nce_falseNs).to(args.device)
-            else:
-                nce_falseNs = None
-            nce_list.append(nce_batch)
-
-        nce_batch = torch.cat(nce_list)
+                nce_falseNs = train_hash.contains(nce_batch).float()
+                nce_weights = nce_weights.to(nce_falseNs.device) * (1.-nce_falseNs)
         p_batch_var = Variable(p_batch).cuda()
         nce_batch = Variable(nce_batch).cuda()
+        nce_weights = nce_weights.cuda()
 
         ''' Number of Active Discriminators '''
         constant = len(masked_fairD_set) - masked_fairD_set.count(None)
-        d_ins = torch.cat([p_batch_var, nce_batch], dim=0).contiguous()
+        if args.shared_negs is not None:
+            d_ins = p_batch_var
+        else:
+            d_ins = torch.cat([p_batch_var, nce_batch], dim=0).contiguous()
 
         ''' Update Encoder '''
         if constant != 0:
@@ -127,8 +127,12 @@ def train_reddit_nce(data_loader,train_hash,counter,args,modelD,optimizerD,\
             if not args.freeze_encoder:
                 optimizerD.zero_grad()
                 p_enrgs = d_outs[:len(p_batch_var)]
-                nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
-                nce_term, nce_term_scores = loss_func(p_enrgs, nce_enrgs)
+                if args.shared_negs is not None:
+                    nce_enrgs = args.shared_negs.score(modelD, p_batch_var, pools, filters=masked_filter_set)
+                else:
+                    nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
+                nce_term, nce_term_scores = loss_func(p_enrgs, nce_enrgs,\
+                        weights=nce_weights)
                 lossD = nce_term + args.gamma*fair_penalty
                 lossD.backward(retain_graph=False)
                 optimizerD.step()
@@ -151,9 +155,13 @@ def train_reddit_nce(data_loader,train_hash,counter,args,modelD,optimizerD,\
             d_outs = modelD(d_ins)
             fair_penalty = Variable(torch.zeros(1)).cuda()
             p_enrgs = d_outs[:len(p_batch_var)]
-            nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
+            if args.shared_negs is not None:
+                nce_enrgs = args.shared_negs.score(modelD, p_batch_var, pools)
+            else:
+                nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
             optimizerD.zero_grad()
-            nce_term, nce_term_scores = loss_func(p_enrgs, nce_enrgs)
+            nce_term, nce_term_scores = loss_func(p_enrgs, nce_enrgs,\
+                    weights=nce_weights)
             lossD = nce_term + args.gamma*fair_penalty
             lossD.backward(retain_graph=False)
             optimizerD.step()
@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import shutil
+import copy
 import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils.data import Dataset, DataLoader
@@ -23,12 +24,17 @@ import logging
 import sys, os
 import subprocess
 from tqdm import tqdm
+from samplers import UniformSampler, BernoulliSampler, SharedNegatives, HardNegativeCache
 from utils import create_or_append, compute_rank
 import joblib
 from collections import Counter
 from model import *
 import ipdb
 from utils import *
+from eval_kb import rank_triplets, test_sequential
+from async_eval import submit_checkpoint, start_worker, finish_worker,\
+        drain_metrics, log_metrics
+from results_store import ResultsStore, rank_metrics
 sys.path.append('../')
 import gc
 from collections import OrderedDict
@@ -52,29 +58,21 @@ class MarginRankingLoss(nn.Module):
         self.num_nce = num_nce
 
     def forward(self, p_enrgs, n_enrgs, weights=None):
-        scores = (self.margin + p_enrgs.repeat(self.num_nce) - n_enrgs).clamp(min=0)
+        ''' n_enrgs holds num_nce blocks of negatives, block k corrupting
+        every positive once, and is scored as a (B, num_nce) matrix. Shared
+        negatives arrive already as a (B, P) matrix '''
+        if n_enrgs.dim() == 1:
+            n_enrgs = n_enrgs.view(self.num_nce, -1).t()
+        scores = (self.margin + p_enrgs.unsqueeze(1) - n_enrgs).clamp(min=0)
 
         if weights is not None:
+            if weights.dim() == 1:
+                weights = weights.view(self.num_nce, -1).t()
             scores = scores * weights / weights.mean()
         return scores.mean(), scores
 
-_cb_var = []
-def corrupt_batch(batch, num_ent):
-    # batch: ltensor type, contains positive triplets
-    batch_size, _ = batch.size()
-
-    corrupted = batch.clone()
-
-    if len(_cb_var) == 0:
-        _cb_var.append(ltensor(batch_size//2).cuda())
-
-    q_samples_l = _cb_var[0].random_(0, num_ent)
-    q_samples_r = _cb_var[0].random_(0, num_ent)
-
-    corrupted[:batch_size//2, 0] = q_samples_l
-    corrupted[batch_size//2:, 2] = q_samples_r
-
-    return corrupted.contiguous(), torch.cat([q_samples_l, q_samples_r])
+''' Uniform head/tail corruption, see samplers.UniformSampler '''
+corrupt_batch = UniformSampler()
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -93,7 +91,16 @@ def parse_args():
     parser.add_argument('--data_dir', type=str, default='./data/', help="Contains Pickle files")
     parser.add_argument('--num_epochs', type=int, default=200, help='Number of training epochs (default: 500)')
     parser.add_argument('--batch_size', type=int, default=64000, help='Batch size (default: 512)')
+    parser.add_argument('--eval_batch_size', type=int, default=64, help='Test triplets ranked per forward pass (default: 64)')
+    parser.add_argument('--rank_ties', type=str, default='optimistic', choices=['optimistic', 'pessimistic', 'realistic'], help='How ties with the target count towards its rank (default: optimistic)')
+    parser.add_argument('--eval_mem_mb', type=int, default=512, help='Memory budget in MB for one chunk of the entity sweep during ranking (default: 512)')
+    parser.add_argument('--eval_workers', type=int, default=1, help='CPU processes ranking test shards in parallel, ignored with CUDA (default: 1)')
+    parser.add_argument('--proj_cache_mb', type=int, default=1024, help='Memory cap in MB for cached per-relation TransD projections during ranking, 0 disables (default: 1024)')
     parser.add_argument('--valid_freq', type=int, default=20, help='Validate frequency in epochs (default: 50)')
+    parser.add_argument('--valid_tol', type=float, default=0, help='Stop validation once the MRR confidence interval is narrower than this, 0 ranks every 20th triplet instead (default: 0)')
+    parser.add_argument('--valid_seed', type=int, default=0, help='Seed of the triplet order used by --valid_tol (default: 0)')
+    parser.add_argument('--async_eval', action='store_true', help='Validate queued checkpoints in a background worker process instead of inline')
+    parser.add_argument('--queue_dir', type=str, default=None, help='Checkpoint queue for --async_eval (default: <outname_base>_eval_queue)')
     parser.add_argument('--print_freq', type=int, default=5, help='Print frequency in epochs (default: 5)')
     parser.add_argument('--embed_dim', type=int, default=50, help='Embedding dimension (default: 50)')
     parser.add_argument('--z_dim', type=int, default=100, help='noise Embedding dimension (default: 100)')
@@ -102,10 +109,18 @@ def parse_args():
     parser.add_argument('--margin', type=float, default=10, help='Loss margin (default: 1)')
     parser.add_argument('--p', type=int, default=1, help='P value for p-norm (default: 1)')
     parser.add_argument('--prefetch_to_gpu', type=int, default=0, help="")
+    parser.add_argument('--batch_iter', type=int, default=1, help='Serve training batches as one permutation per epoch and one index gather per batch, instead of per-row DataLoader collation (default: 1)')
     parser.add_argument('--D_nce_weight', type=float, default=1, help="D nce term weight")
     parser.add_argument('--use_trained_filters', type=bool, default=False, help='Sample a binary mask for discriminators to use')
     parser.add_argument('--full_loss_penalty', type=int, default=0, help="")
     parser.add_argument('--filter_false_negs', type=int, default=1, help="filter out sampled false negatives")
+    parser.add_argument('--sampler', type=str, default='uniform', choices=['uniform', 'bernoulli'], help='Negative sampling: head/tail halves of the batch, or per-relation Bernoulli choice (default: uniform)')
+    parser.add_argument('--num_nce', type=int, default=1, help='Corruptions per positive, scored in the same forward pass (default: 1)')
+    parser.add_argument('--neg_pool', type=int, default=-1, help='Shared negatives scored as a (B, P) matrix: 0 uses the entities of the batch, P > 0 a pool of P random entities, -1 draws num_nce corruptions per positive (default: -1)')
+    parser.add_argument('--neg_pool_mb', type=int, default=1024, help='Memory budget in MB for the (B, P) shared negative step; larger pools are capped to fit (default: 1024)')
+    parser.add_argument('--hard_negs', type=int, default=0, help='Cached hard negatives per training (h, r) and (r, t), 0 disables (default: 0)')
+    parser.add_argument('--hard_frac', type=float, default=0.5, help='Share of corruptions drawn from the hard-negative cache (default: 0.5)')
+    parser.add_argument('--hard_refresh', type=int, default=5, help='Epochs between hard-negative cache rebuilds (default: 5)')
     parser.add_argument('--ace', type=int, default=0, help="do ace training (otherwise just NCE)")
     parser.add_argument('--false_neg_penalty', type=float, default=1., help="false neg penalty for G")
     parser.add_argument('--mb_reward_normalization', type=int, default=0, help="minibatch based reward normalization")
@@ -129,8 +144,7 @@ def parse_args():
     if args.dataset == 'WN' or args.dataset == 'FB15k':
         path = './data/' + args.dataset + '-%s.pkl'
 
-        args.num_ent = len(json.load(open('./data/%s-ent_to_idx.json' % args.dataset, 'r')))
-        args.num_rel = len(json.load(open('./data/%s-rel_to_idx.json' % args.dataset, 'r')))
+        args.num_ent, args.num_rel = vocab_sizes(args.dataset)
         args.data_path = path
     else:
         raise Exception("Argument 'dataset' can only be 'WN' or 'FB15k'.")
@@ -235,7 +249,7 @@ def train(data_loader, counter, args, train_hash, modelD, optimizerD,\
     correct = 0
     total_ent = 0
     fairD_0_loss, fairD_1_loss, fairD_2_loss = 0,0,0
-    loss_func = MarginRankingLoss(args.margin,1)
+    loss_func = MarginRankingLoss(args.margin,args.num_nce)
     if args.show_tqdm:
         data_itr = tqdm(enumerate(data_loader))
     else:
@@ -253,23 +267,25 @@ def train(data_loader, counter, args, train_hash, modelD, optimizerD,\
             masked_optimizer_fairD_set = optimizer_fairD_set
             masked_filter_set = filter_set
 
-        nce_batch, q_samples = corrupt_batch(p_batch, args.num_ent)
-
-        if args.filter_false_negs:
-            if args.prefetch_to_gpu:
-                nce_np = nce_batch.cpu().numpy()
-            else:
-                nce_np = nce_batch.numpy()
-
-            nce_falseNs = ftensor(np.array([int(x.tobytes() in train_hash) for x in nce_np], dtype=np.float32))
-            nce_falseNs = Variable(nce_falseNs.cuda()) if args.use_cuda else Variable(nce_falseNs)
+        if args.shared_negs is not None:
+            ''' One candidate pool per side, scored against every positive.
+            False negatives are dropped from the (B, P) weights directly '''
+            pools, nce_weights = args.shared_negs(p_batch,\
+                    train_hash if args.filter_false_negs else None)
+            nce_batch, q_samples = p_batch[:0], pools[0]
         else:
-            nce_falseNs = None
+            ''' All num_nce corruptions of the batch are drawn in one call '''
+            nce_batch, q_samples = args.corrupt(p_batch.repeat(args.num_nce, 1), args.num_ent)
+            nce_weights = torch.ones(len(nce_batch))
+            if args.filter_false_negs:
+                nce_falseNs = train_hash.contains(nce_batch).float()
+                nce_weights = nce_weights.to(nce_falseNs.device) * (1.-nce_falseNs)
 
         if args.use_cuda:
             p_batch = p_batch.cuda()
             nce_batch = nce_batch.cuda()
             q_samples = q_samples.cuda()
+            nce_weights = nce_weights.cuda()
 
         p_batch_var = Variable(p_batch)
         nce_batch = Variable(nce_batch)
@@ -279,7 +295,10 @@ def train(data_loader, counter, args, train_hash, modelD, optimizerD,\
         constant = len(masked_fairD_set) - masked_fairD_set.count(None)
         force_ce = args.force_ce
         if args.ace == 0:
-            d_ins = torch.cat([p_batch_var, nce_batch], dim=0).contiguous()
+            if args.shared_negs is not None:
+                d_ins = p_batch_var
+            else:
+                d_ins = torch.cat([p_batch_var, nce_batch], dim=0).contiguous()
             if constant != 0 and not args.freeze_transD:
                 optimizerD.zero_grad()
                 d_outs,lhs_emb,rhs_emb = modelD(d_ins,True,filters=masked_filter_set)
@@ -302,8 +321,11 @@ def train(data_loader, counter, args, train_hash, modelD, optimizerD,\
 
                 if not args.freeze_transD:
                     p_enrgs = d_outs[:len(p_batch_var)]
-                    nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
-                    nce_term, nce_term_scores  = loss_func(p_enrgs, nce_enrgs, weights=(1.-nce_falseNs))
+                    if args.shared_negs is not None:
+                        nce_enrgs = args.shared_negs.score(modelD, p_batch_var, pools, filters=masked_filter_set)
+                    else:
+                        nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
+                    nce_term, nce_term_scores  = loss_func(p_enrgs, nce_enrgs, weights=nce_weights)
                     lossD = nce_term + args.gamma*fair_penalty
                     lossD.backward()
                     optimizerD.step()
@@ -346,8 +368,11 @@ def train(data_loader, counter, args, train_hash, modelD, optimizerD,\
                 d_outs = modelD(d_ins)
                 fair_penalty = Variable(torch.zeros(1)).cuda()
                 p_enrgs = d_outs[:len(p_batch_var)]
-                nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
-                nce_term, nce_term_scores  = loss_func(p_enrgs, nce_enrgs, weights=(1.-nce_falseNs))
+                if args.shared_negs is not None:
+                    nce_enrgs = args.shared_negs.score(modelD, p_batch_var, pools)
+                else:
+                    nce_enrgs = d_outs[len(p_batch_var):(len(p_batch_var)+len(nce_batch))]
+                nce_term, nce_term_scores  = loss_func(p_enrgs, nce_enrgs, weights=nce_weights)
                 lossD = nce_term + args.gamma*fair_penalty
                 lossD.backward()
                 optimizerD.step()
@@ -477,56 +502,55 @@ def test_fairness(dataset,args,modelD,tflogger,fairD,attribute,\
                 Accuracy',float(acc),epoch)
         experiment.log_metric("Test "+attribute+" AUC",float(AUC),step=epoch)
         experiment.log_metric("Test "+attribute+" Accuracy",float(acc),step=epoch)
-
-def test(dataset, args, all_hash, modelD, tflogger, filter_set, experiment, subsample=1):
-    l_ranks, r_ranks = [], []
-    test_loader = DataLoader(dataset, num_workers=1, collate_fn=collate_fn)
-
-    cst_inds = np.arange(args.num_ent, dtype=np.int64)[:,None]
-
-    if args.show_tqdm:
-        data_itr = tqdm(enumerate(test_loader))
-    else:
-        data_itr = enumerate(test_loader)
-
-    for idx, triplet in data_itr:
-        if idx % subsample != 0:
-            continue
-
-        lhs, rel, rhs = triplet.view(-1)
-
-        l_batch = np.concatenate([cst_inds, np.array([[rel, rhs]]).repeat(args.num_ent, axis=0)], axis=1)
-        r_batch = np.concatenate([np.array([[lhs, rel]]).repeat(args.num_ent, axis=0), cst_inds], axis=1)
-
-        l_fns = np.array([int(x.tobytes() in all_hash) for x in l_batch], dtype=np.float32)
-        r_fns = np.array([int(x.tobytes() in all_hash) for x in r_batch], dtype=np.float32)
-
-        l_batch = ltensor(l_batch).contiguous()
-        r_batch = ltensor(r_batch).contiguous()
-
-        if args.use_cuda:
-            l_batch = l_batch.cuda()
-            r_batch = r_batch.cuda()
-
-        l_batch = Variable(l_batch)
-        r_batch = Variable(r_batch)
-
-        d_ins = torch.cat([l_batch, r_batch], dim=0)
-        d_outs = modelD(d_ins,filters=filter_set)
-        l_enrgs = d_outs[:len(l_batch)]
-        r_enrgs = d_outs[len(l_batch):]
-
-        l_rank = compute_rank(v2np(l_enrgs), lhs, mask_observed=l_fns)
-        r_rank = compute_rank(v2np(r_enrgs), rhs, mask_observed=r_fns)
-
-        l_ranks.append(l_rank)
-        r_ranks.append(r_rank)
-
-    l_ranks = np.array(l_ranks)
-    r_ranks = np.array(r_ranks)
+    return acc, AUC
+
+def test(dataset, args, all_known, modelD, tflogger, filter_set, experiment, subsample=1):
+    triplets = dataset.dataset[::subsample]
+    modelD.cache_projections(args.proj_cache_mb, filters=filter_set)
+    try:
+        l_ranks, r_ranks = rank_triplets(triplets, modelD, all_known,\
+                batch_size=args.eval_batch_size, filters=filter_set,\
+                use_cuda=args.use_cuda, show_tqdm=args.show_tqdm,\
+                ties=args.rank_ties, mem_budget=args.eval_mem_mb,\
+                num_workers=args.eval_workers)
+    finally:
+        modelD.cache_projections(0)
 
     return l_ranks, r_ranks
 
+def evaluate_checkpoint(epoch, modules, args, test_set, all_known):
+    ''' Validation of a queued checkpoint, run by the async_eval worker '''
+    modelD = modules['modelD']
+    filter_set = [modules['filter_%d' % i] for i in range(3)]
+    with torch.no_grad():
+        l_ranks, r_ranks = test(test_set,args,all_known,\
+                modelD,None,filter_set,None,subsample=20)
+    metrics = rank_metrics(l_ranks, r_ranks)
+
+    for i in range(3):
+        fairD = modules['fairD_%d' % i]
+        if fairD is not None:
+            acc, AUC = test_fairness(test_set,args,modelD,None,fairD,\
+                    attribute=str(i),epoch=epoch,experiment=None,\
+                    filter_=filter_set[i])
+            metrics['Test %d Accuracy' % i] = acc
+            metrics['Test %d AUC' % i] = AUC
+
+    ResultsStore(args.outname_base + '_results').append(epoch, l_ranks, r_ranks)
+    return metrics
+
+def log_async_metrics(metrics, args, experiment, tflogger, best_mrr):
+    ''' Log the ranking metrics the async_eval worker wrote back for one
+    epoch as inline validation does, and return the updated best MRR '''
+    epoch = metrics['epoch']
+    log_metrics(experiment, metrics)
+    if args.do_log:
+        tflogger.scalar_summary('Mean Rank',float(metrics['mr']),epoch)
+        tflogger.scalar_summary('Mean Reciprocal Rank',float(metrics['mrr']),epoch)
+        tflogger.scalar_summary('Hit @10',float(metrics['h10']),epoch)
+        tflogger.scalar_summary('Hit @5',float(metrics['h5']),epoch)
+    return metrics['mrr'] if best_mrr is None else max(best_mrr, metrics['mrr'])
+
 def retrain_disc(args,experiment,train_loader,train_hash,test_set,modelD,optimizerD,tflogger,\
         filter_0,filter_1,filter_2,attribute):
 
@@ -653,14 +677,25 @@ def main(args):
         test_set = FBDataset(args.data_path % 'test')
         print('50 Most Commone Attributes')
 
-    if args.prefetch_to_gpu:
-        train_hash = set([r.tobytes() for r in train_set.dataset.cpu().numpy()])
+    if args.sampler == 'bernoulli':
+        args.corrupt = BernoulliSampler(train_set.dataset, args.num_ent, args.num_rel)
     else:
-        train_hash = set([r.tobytes() for r in train_set.dataset])
+        args.corrupt = corrupt_batch
+    if args.hard_negs > 0:
+        args.corrupt = HardNegativeCache(args.corrupt,\
+                KnownTriples([train_set.dataset], args.num_ent, args.num_rel),\
+                args.hard_negs, hard_frac=args.hard_frac)
+    if args.neg_pool >= 0:
+        args.shared_negs = SharedNegatives(args.neg_pool, (0, 2),\
+                (args.num_ent, args.num_ent), max_mb=args.neg_pool_mb)
+    else:
+        args.shared_negs = None
+
+    train_hash = PackedKeys(train_set.dataset, (args.num_ent, args.num_rel, args.num_ent),\
+            device='cuda' if args.use_cuda else 'cpu')
 
-    all_hash = train_hash.copy()
-    all_hash.update(set([r.tobytes() for r in valid_set.dataset]))
-    all_hash.update(set([r.tobytes() for r in test_set.dataset]))
+    all_known = KnownTriples([train_set.dataset, valid_set.dataset, test_set.dataset],\
+            args.num_ent, args.num_rel)
     logdir = args.outname_base + '_logs' + '/'
     if args.remove_old_run:
         shutil.rmtree(logdir)
@@ -770,7 +805,7 @@ def main(args):
         # optimizerD = optimizer(modelD.parameters(), 'adam', args.lr)
     schedulerD = lr_scheduler(optimizerD, args.decay_lr, args.num_epochs)
 
-    loss_func = MarginRankingLoss(args.margin,1)
+    loss_func = MarginRankingLoss(args.margin,args.num_nce)
 
     _cst_inds = torch.LongTensor(np.arange(args.num_ent, \
             dtype=np.int64)[:,None]).cuda().repeat(1, args.batch_size//2)
@@ -778,8 +813,11 @@ def main(args):
     _cst_s_nb = torch.LongTensor(np.arange(args.batch_size//2,args.batch_size)).cuda()
     _cst_nb = torch.LongTensor(np.arange(args.batch_size)).cuda()
 
-    if args.prefetch_to_gpu:
-        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
+    if args.batch_iter:
+        train_loader = BatchLoader(train_set, args.batch_size, shuffle=True, drop_last=True,
+                                   pin_memory=args.use_cuda and not args.prefetch_to_gpu)
+    elif args.prefetch_to_gpu:
+        train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=False, drop_last=True,
                                   num_workers=0, collate_fn=collate_fn)
     else:
         train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
@@ -787,10 +825,46 @@ def main(args):
     if args.freeze_transD:
         freeze_model(modelD)
 
+    best_mrr = None
+    results = ResultsStore(args.outname_base + '_results')
     ''' Joint Training '''
     if not args.dont_train:
+        results.reset()
+        if args.async_eval:
+            args.queue_dir = args.queue_dir or args.outname_base + '_eval_queue'
+            eval_modules = {'modelD': modelD}
+            for i in range(3):
+                eval_modules['filter_%d' % i] = filter_set[i]
+                eval_modules['fairD_%d' % i] = fairD_set[i]
+            worker_args = copy.copy(args)
+            worker_args.do_log = False
+            logged_epochs = set()
+            eval_worker = start_worker(args.queue_dir, evaluate_checkpoint,\
+                    eval_modules, (worker_args, test_set, all_known),\
+                    'cuda' if args.use_cuda else 'cpu')
+        hard_refresh_total = 0.
         with experiment.train():
             for epoch in tqdm(range(1, args.num_epochs + 1)):
+                if args.prefetch_to_gpu and not args.batch_iter:
+                    ''' The loader reads the GPU-resident rows in order, so they
+                    are permuted on the device once per epoch '''
+                    train_set.shuffle()
+                if args.hard_negs > 0 and epoch > 1 and (epoch - 1) % args.hard_refresh == 0:
+                    ''' Timed apart from training to weigh it against epochs saved '''
+                    modelD.cache_projections(args.proj_cache_mb)
+                    try:
+                        refresh_time = args.corrupt.refresh(modelD,\
+                                batch_size=args.eval_batch_size,\
+                                mem_budget=args.eval_mem_mb, use_cuda=args.use_cuda)
+                    finally:
+                        modelD.cache_projections(0)
+                    hard_refresh_total += refresh_time
+                    print("Hard negatives refreshed in %.1fs (%.1fs total)" %\
+                            (refresh_time, hard_refresh_total))
+                    experiment.log_metric("Hard Negative Refresh Seconds",\
+                            refresh_time, step=epoch)
+                    experiment.log_metric("Hard Negative Refresh Total Seconds",\
+                            hard_refresh_total, step=epoch)
                 train(train_loader,epoch,args,train_hash,modelD,optimizerD,\
                         tflogger,fairD_set,optimizer_fairD_set,filter_set,experiment)
                 gc.collect()
@@ -800,10 +874,20 @@ def main(args):
                     else:
                         schedulerD.step()
 
-                if epoch % args.valid_freq == 0:
+                if epoch % args.valid_freq == 0 and args.async_eval:
+                    submit_checkpoint(args.queue_dir, epoch, eval_modules)
+                    modelD.save(args.outname_base+'D_epoch{}.pts'.format(epoch))
+                    for metrics in drain_metrics(args.queue_dir, logged_epochs):
+                        best_mrr = log_async_metrics(metrics, args, experiment,\
+                                tflogger, best_mrr)
+                elif epoch % args.valid_freq == 0:
                     with torch.no_grad():
-                        l_ranks, r_ranks = test(test_set,args,all_hash,\
-                                modelD,tflogger,filter_set,experiment,subsample=20)
+                        if args.valid_tol > 0:
+                            l_ranks, r_ranks = test_sequential(test_set,args,all_known,\
+                                    modelD,filter_set,experiment,best_mrr=best_mrr)
+                        else:
+                            l_ranks, r_ranks = test(test_set,args,all_known,\
+                                    modelD,tflogger,filter_set,experiment,subsample=20)
                         l_mean = l_ranks.mean()
                         r_mean = r_ranks.mean()
                         l_mrr = (1. / l_ranks).mean()
@@ -816,6 +900,7 @@ def main(args):
                         avg_mrr = (l_mrr+r_mrr)/2
                         avg_h10 = (l_h10+r_h10)/2
                         avg_h5 = (l_h5+r_h5)/2
+                        best_mrr = avg_mrr if best_mrr is None else max(best_mrr, avg_mrr)
 
                     if args.use_attr:
                         test_fairness(test_set,args, modelD,tflogger,\
@@ -840,8 +925,7 @@ def main(args):
                                 fairD_2,attribute='2',epoch=epoch,\
                                 experiment=experiment,filter_=filter_2)
 
-                    joblib.dump({'l_ranks':l_ranks,'r_ranks':r_ranks},args.outname_base+\
-                                'epoch{}_validation_ranks.pkl'.format(epoch), compress=9)
+                    results.append(epoch, l_ranks, r_ranks)
 
                     print("Mean Rank is %f" %(float(avg_mr)))
                     if args.do_log: # Tensorboard logging
@@ -853,8 +937,8 @@ def main(args):
 
                     modelD.save(args.outname_base+'D_epoch{}.pts'.format(epoch))
 
-                if epoch % (args.valid_freq * 5) == 0:
-                    l_ranks, r_ranks = test(test_set,args,all_hash,modelD,\
+                if epoch % (args.valid_freq * 5) == 0 and not args.async_eval:
+                    l_ranks, r_ranks = test(test_set,args,all_known,modelD,\
                             tflogger,filter_set,experiment,subsample=20)
                     l_mean = l_ranks.mean()
                     r_mean = r_ranks.mean()
@@ -865,6 +949,12 @@ def main(args):
                     l_h5 = (l_ranks <= 5).mean()
                     r_h5 = (r_ranks <= 5).mean()
 
+        if args.async_eval:
+            finish_worker(args.queue_dir, eval_worker)
+            for metrics in drain_metrics(args.queue_dir, logged_epochs):
+                best_mrr = log_async_metrics(metrics, args, experiment,\
+                        tflogger, best_mrr)
+
     if args.sample_mask:
         filter_0.save(args.outname_base+'Filter_0.pts')
         filter_1.save(args.outname_base+'Filter_1.pts')
@@ -10,7 +10,8 @@ import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils.data import Dataset, DataLoader
 from torch.distributions import Categorical
-from utils import create_or_append, compute_rank
+from samplers import UniformSampler, BernoulliSampler
+from utils import create_or_append, compute_rank, load_triples, vocab_sizes
 import numpy as np
 import random
 import argparse
@@ -83,7 +84,7 @@ class MarginRankingLoss(nn.Module):
 class KBDataset(Dataset):
     def __init__(self, path, prefetch_to_gpu=False):
         self.prefetch_to_gpu = prefetch_to_gpu
-        self.dataset = np.ascontiguousarray(np.array(pickle.load(open(path, 'rb'))))
+        self.dataset = load_triples(path)
         if prefetch_to_gpu:
             self.dataset = ltensor(self.dataset).cuda()
 
@@ -119,6 +120,7 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, default=1024, help='Batch size (default: 512)')
     parser.add_argument('--valid_freq', type=int, default=10, help='Validate frequency in epochs (default: 50)')
     parser.add_argument('--filter_false_negs', type=int, default=1, help="filter out sampled false negatives")
+    parser.add_argument('--sampler', type=str, default='uniform', choices=['uniform', 'bernoulli'], help='Negative sampling: head/tail halves of the batch, or per-relation Bernoulli choice (default: uniform)')
     parser.add_argument('--print_freq', type=int, default=5, help='Print frequency in epochs (default: 5)')
     parser.add_argument('--embed_dim', type=int, default=50, help='Embedding dimension (default: 50)')
     parser.add_argument('--lr', type=float, default=0.004, help='Learning rate (default: 0.001)')
@@ -140,8 +142,7 @@ def parse_args():
         path = './data/' + args.dataset + '-%s.pkl'
     else:
         raise Exception("Argument 'dataset' can only be 'WN' or 'FB15k'.")
-    args.num_ent = len(json.load(open('./data/%s-ent_to_idx.json' % args.dataset, 'r')))
-    args.num_rel = len(json.load(open('./data/%s-rel_to_idx.json' % args.dataset, 'r')))
+    args.num_ent, args.num_rel = vocab_sizes(args.dataset)
     args.data_path = path
 
     args.outname_base = os.path.join(args.save_dir,
@@ -229,23 +230,8 @@ def collect_all(d, num):
 
     return d
 
-_cb_var = []
-def corrupt_batch(batch, num_ent):
-    # batch: ltensor type, contains positive triplets
-    batch_size, _ = batch.size()
-
-    corrupted = batch.clone()
-
-    if len(_cb_var) == 0:
-        _cb_var.append(ltensor(batch_size//2).cuda())
-
-    q_samples_l = _cb_var[0].random_(0, num_ent)
-    q_samples_r = _cb_var[0].random_(0, num_ent)
-
-    corrupted[:batch_size//2, 0] = q_samples_l
-    corrupted[batch_size//2:, 2] = q_samples_r
-
-    return corrupted.contiguous(), torch.cat([q_samples_l, q_samples_r])
+''' Uniform head/tail corruption, see samplers.UniformSampler '''
+corrupt_batch = UniformSampler()
 
 ##@profile
 def main(args):
@@ -254,6 +240,11 @@ def main(args):
     valid_set = KBDataset(args.data_path % 'valid')
     test_set = KBDataset(args.data_path % 'test')
 
+    if args.sampler == 'bernoulli':
+        corrupt = BernoulliSampler(train_set.dataset, args.num_ent, args.num_rel)
+    else:
+        corrupt = corrupt_batch
+
     train_hash = set([r.tobytes() for r in train_set.dataset])
     modelD = TransE(args.num_ent, args.num_rel, args.embed_dim, args.p)
 
@@ -279,7 +270,7 @@ def main(args):
         lossesD = []
 
         for idx, p_batch in tqdm(enumerate(data_loader)):
-            nce_batch, q_samples = corrupt_batch(p_batch, args.num_ent)
+            nce_batch, q_samples = corrupt(p_batch, args.num_ent)
 
             if args.use_cuda:
                 p_batch = p_batch.cuda()
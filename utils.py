@@ -2,45 +2,98 @@ import torch
 import numpy as np
 from torch.utils.data import Dataset, DataLoader
 import pickle
+import json
+import os
 from collections import defaultdict
 import ipdb
 
+def load_triples(path):
+    ''' (N, 3) int64 triplets of one split. When parse.py left a .npy next
+    to the .pkl, it is memory-mapped read-only, so startup does not parse
+    anything and processes on one box share the page cache. Older pickled
+    splits are unpickled as before. A .npy that disagrees with the row
+    count or dtype in the manifest (truncated or left over from an older
+    parse) raises a ValueError '''
+    npy_path = os.path.splitext(path)[0] + '.npy'
+    if os.path.exists(npy_path):
+        triples = np.load(npy_path, mmap_mode='r')
+        check_manifest(npy_path, triples)
+        return triples
+    return np.ascontiguousarray(np.array(pickle.load(open(path, 'rb'))))
+
+def check_manifest(npy_path, triples):
+    ''' Match a ./data/<dataset>-<split>.npy against <dataset>-manifest.json,
+    when parse.py wrote one '''
+    base = os.path.splitext(npy_path)[0]
+    if '-' not in os.path.basename(base):
+        return
+    prefix, split = base.rsplit('-', 1)
+    manifest_fn = prefix + '-manifest.json'
+    if not os.path.exists(manifest_fn):
+        return
+    manifest = json.load(open(manifest_fn, 'r'))
+    expected = (manifest['counts'].get(split), 3)
+    if triples.shape != expected or triples.dtype != np.dtype(manifest['dtype']):
+        raise ValueError("%s holds %s %s triplets, %s expects %s %s" % (npy_path,\
+                triples.shape, triples.dtype, manifest_fn, expected, manifest['dtype']))
+
+def vocab_sizes(dataset, data_dir='./data'):
+    ''' (num_ent, num_rel) from the manifest parse.py writes, falling back
+    to the length of the vocabulary json files '''
+    manifest_fn = os.path.join(data_dir, '%s-manifest.json' % dataset)
+    if os.path.exists(manifest_fn):
+        manifest = json.load(open(manifest_fn, 'r'))
+        return manifest['num_ent'], manifest['num_rel']
+    num_ent = len(json.load(open(os.path.join(data_dir, '%s-ent_to_idx.json' % dataset), 'r')))
+    num_rel = len(json.load(open(os.path.join(data_dir, '%s-rel_to_idx.json' % dataset), 'r')))
+    return num_ent, num_rel
+
+def shuffle_rows(data, prefetch_to_gpu=False):
+    ''' Rows of `data` in a fresh random order, permuted where they live:
+    tensors through a torch.randperm index on their own device, numpy arrays
+    through a numpy one. A prefetch_to_gpu array is moved to the GPU once
+    and stays there '''
+    if prefetch_to_gpu and not torch.is_tensor(data):
+        data = torch.as_tensor(data).cuda()
+    if torch.is_tensor(data):
+        return data.index_select(0, torch.randperm(len(data), device=data.device))
+    return data[np.random.permutation(len(data))]
+
 class RedditDataset(Dataset):
-    def __init__(self,edges,u_to_idx,sr_to_idx,prefetch_to_gpu=False):
+    ''' Reddit edges pre-encoded once into a contiguous (E, 2) int64 array
+    of [user, sr] rows, whichever way round the graph stored them. Indexing
+    with an int, a slice or an index array serves rows straight from it.
+    `encoded` skips the encoding, e.g. with rows from load_reddit_edges '''
+    def __init__(self,edges,u_to_idx,sr_to_idx,prefetch_to_gpu=False,encoded=None):
         self.dataset = edges
         self.u_to_idx = u_to_idx
         self.sr_to_idx = sr_to_idx
         self.prefetch_to_gpu = prefetch_to_gpu
         self.edges = edges
+        if encoded is None:
+            encoded = encode_reddit_edges(edges, u_to_idx, sr_to_idx)
+        self.encoded = np.ascontiguousarray(encoded, dtype=np.int64)
 
     def __len__(self):
-        return len(self.dataset)
+        return len(self.encoded)
 
     def get_mapping(self,edge):
-        if edge[0].split('_')[0] == 'U':
-            user = torch.LongTensor([self.u_to_idx[edge[0]]])
-            sr = torch.LongTensor([self.sr_to_idx[edge[1]]])
-        else:
-            user = torch.LongTensor([self.u_to_idx[edge[1]]])
-            sr = torch.LongTensor([self.sr_to_idx[edge[0]]])
-        datum = torch.cat((user,sr),0)
-        return datum
+        return torch.from_numpy(encode_reddit_edges([edge], self.u_to_idx,\
+                self.sr_to_idx)[0])
 
     def __getitem__(self, idx):
         ''' Always return [User, SR] '''
-        edge = self.dataset[idx]
-        if edge[0].split('_')[0] == 'U':
-            user = torch.LongTensor([self.u_to_idx[edge[0]]])
-            sr = torch.LongTensor([self.sr_to_idx[edge[1]]])
-        else:
-            user = torch.LongTensor([self.u_to_idx[edge[1]]])
-            sr = torch.LongTensor([self.sr_to_idx[edge[0]]])
-        datum = torch.cat((user,sr),0)
-        return datum
+        return torch.from_numpy(self.encoded[idx])
 
     def shuffle(self):
-        data = self.dataset
-        np.random.shuffle(data)
+        ''' Rebinds the rows to a permuted copy, which also works for the
+        read-only memmaps of a RedditArtifact, and reorders the string
+        edges, when there are any, to match '''
+        perm = np.random.permutation(len(self.encoded))
+        self.encoded = self.encoded[perm]
+        if self.edges is not None:
+            self.edges = [self.edges[i] for i in perm]
+            self.dataset = self.edges
 
 class KBDataset(Dataset):
     def __init__(self,data_split,prefetch_to_gpu=False):
@@ -54,21 +107,12 @@ class KBDataset(Dataset):
         return self.dataset[idx]
 
     def shuffle(self):
-        if self.dataset.is_cuda:
-            self.dataset = self.dataset.cpu()
-
-        data = self.dataset
-        np.random.shuffle(data)
-        data = np.ascontiguousarray(data)
-        self.dataset = ltensor(data)
-
-        if self.prefetch_to_gpu:
-            self.dataset = self.dataset.cuda().contiguous()
+        self.dataset = shuffle_rows(self.dataset, self.prefetch_to_gpu)
 
 class FBDataset(Dataset):
     def __init__(self, path, prefetch_to_gpu=False):
         self.prefetch_to_gpu = prefetch_to_gpu
-        self.dataset = np.ascontiguousarray(np.array(pickle.load(open(path, 'rb'))))
+        self.dataset = load_triples(path)
         if prefetch_to_gpu:
             self.dataset = torch.LongTensor(self.dataset).cuda()
 
@@ -79,16 +123,7 @@ class FBDataset(Dataset):
         return self.dataset[idx]
 
     def shuffle(self):
-        if self.dataset.is_cuda:
-            self.dataset = self.dataset.cpu()
-
-        data = self.dataset.numpy()
-        np.random.shuffle(data)
-        data = np.ascontiguousarray(data)
-        self.dataset = torch.LongTensor(data)
-
-        if self.prefetch_to_gpu:
-            self.dataset = self.dataset.cuda().contiguous()
+        self.dataset = shuffle_rows(self.dataset, self.prefetch_to_gpu)
 
 class NodeClassification(Dataset):
     def __init__(self,data_split,prefetch_to_gpu=False):
@@ -102,15 +137,76 @@ class NodeClassification(Dataset):
         return self.dataset[idx]
 
     def shuffle(self):
-        if self.dataset.is_cuda:
-            self.dataset = self.dataset.cpu()
+        ''' Users keep their order, as they always have; a prefetch_to_gpu
+        split is only moved to the GPU '''
+        if self.prefetch_to_gpu and not torch.is_tensor(self.dataset):
+            self.dataset = torch.as_tensor(self.dataset).cuda()
+
+class BatchLoader(object):
+    ''' Batch-level stand-in for DataLoader over KBDataset, FBDataset,
+    NodeClassification or RedditDataset: one permutation per epoch and one
+    index gather per batch, with no per-row __getitem__ or collate_fn. The
+    rows stay where the dataset keeps them: a prefetch_to_gpu dataset is
+    moved to the GPU once and permuted there, a CPU one can hand out
+    pinned batches for non-blocking copies. Pinned batches are gathered into
+    two reusable buffers per batch size, alternating between steps, so a
+    batch is overwritten two steps later and a consumer that keeps it
+    longer must clone it '''
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False,\
+            pin_memory=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        ''' Pinned buffers and their events need CUDA; without it batches
+        are plain index_select gathers '''
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._source, self._data = None, None
+        self._pinned = {}
+
+    def data(self):
+        ''' The dataset rows as a LongTensor, rebuilt if the dataset replaced
+        its array since the last epoch '''
+        source = getattr(self.dataset, 'encoded', self.dataset.dataset)
+        if source is not self._source:
+            data = torch.as_tensor(source).long()
+            if self.dataset.prefetch_to_gpu and not data.is_cuda:
+                data = data.cuda()
+            self._source, self._data = source, data
+        return self._data
 
-        data = self.dataset
-        data = np.ascontiguousarray(data)
-        self.dataset = ltensor(data)
+    def __len__(self):
+        n = len(self.dataset)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        data = self.data()
+        if self.shuffle:
+            order = torch.randperm(len(data), device=data.device)
+        else:
+            order = torch.arange(len(data), device=data.device)
+        for i in range(len(self)):
+            idx = order[i*self.batch_size:(i+1)*self.batch_size]
+            if self.pin_memory and not data.is_cuda:
+                buf, copied = self.pinned_buffer(data, len(idx), i % 2)
+                ''' Wait for a copy of this buffer that may still be in flight '''
+                copied.synchronize()
+                batch = torch.index_select(data, 0, idx, out=buf)
+                yield batch
+                copied.record()
+            else:
+                yield data.index_select(0, idx)
 
-        if self.prefetch_to_gpu:
-            self.dataset = self.dataset.cuda().contiguous()
+    def pinned_buffer(self, data, size, slot):
+        ''' Pinned (buffer, cuda event) for `size` rows of `data`. The event
+        marks the last step that read the buffer '''
+        key = (size, slot, data.dtype) + tuple(data.shape[1:])
+        if key not in self._pinned:
+            buf = torch.empty((size,) + tuple(data.shape[1:]), dtype=data.dtype).pin_memory()
+            self._pinned[key] = (buf, torch.cuda.Event())
+        return self._pinned[key]
 
 class PredBias(Dataset):
     def __init__(self,use_1M,movies,users,attribute,prefetch_to_gpu=False):
@@ -158,16 +254,7 @@ class PredBias(Dataset):
         return self.dataset[idx]
 
     def shuffle(self):
-        if self.dataset.is_cuda:
-            self.dataset = self.dataset.cpu()
-
-        data = self.dataset
-        np.random.shuffle(data)
-        data = np.ascontiguousarray(data)
-        self.dataset = ltensor(data)
-
-        if self.prefetch_to_gpu:
-            self.dataset = self.dataset.cuda().contiguous()
+        self.dataset = shuffle_rows(self.dataset, self.prefetch_to_gpu)
 
 def reddit_check_edges(edges):
     print("Printing Bad Edges")
@@ -191,6 +278,303 @@ def reddit_mappings(nodes):
         sr_to_idx[sr] = j
     return user_to_idx, sr_to_idx
 
+class RedditGraph(object):
+    ''' Array-backed stand-in for the networkx k-core graph written by
+    create_reddit_graph: the (E, 2) int64 [user, sr] edge array and both
+    name vocabularies, behind the parts of the nx.Graph API main_reddit and
+    RedditDiscriminator use. nodes() lists users then subreddits in id
+    order, so reddit_mappings reproduces the ids of `edge_array` '''
+    def __init__(self, edge_array, users, subreddits):
+        self.edge_array = edge_array
+        self.users = users
+        self.subreddits = subreddits
+        self.user_degree = np.bincount(edge_array[:, 0], minlength=len(users))
+        self.sr_degree = np.bincount(edge_array[:, 1], minlength=len(subreddits))
+        self.sr_to_idx = {sr: i for i, sr in enumerate(subreddits)}
+
+    def nodes(self):
+        return list(self.users) + list(self.subreddits)
+
+    def edges(self):
+        return [(self.users[u], self.subreddits[sr]) for u, sr in self.edge_array]
+
+    def number_of_edges(self):
+        return len(self.edge_array)
+
+    @property
+    def degree(self):
+        return list(zip(self.users, self.user_degree)) +\
+                list(zip(self.subreddits, self.sr_degree))
+
+    def neighbors(self, sr):
+        ''' Users of one subreddit '''
+        users = self.edge_array[self.edge_array[:, 1] == self.sr_to_idx[sr], 0]
+        return iter(self.users[users])
+
+REDDIT_ARTIFACT_VERSION = 1
+
+class RedditVocab(object):
+    ''' Name -> id lookup over a sorted name array, by searchsorted, so a
+    memory-mapped vocabulary stands in for the u_to_idx / sr_to_idx dicts
+    without building them '''
+    def __init__(self, names):
+        self.names = names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        idx = np.searchsorted(self.names, name)
+        return idx < len(self.names) and self.names[idx] == name
+
+    def __getitem__(self, name):
+        idx = np.searchsorted(self.names, name)
+        if idx == len(self.names) or self.names[idx] != name:
+            raise KeyError(name)
+        return int(idx)
+
+class RedditArtifact(object):
+    ''' Memory-mapped view of a directory written by build_reddit_artifact:
+    encoded edges, sorted vocabularies, the subreddits in degree order, the
+    user x subreddit membership as CSR and the train/test splits of `seed`.
+    Covers what main_reddit and RedditDiscriminator used the graph for '''
+    def __init__(self, path, seed):
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != REDDIT_ARTIFACT_VERSION:
+            raise ValueError("%s is a version %d artifact, expected %d; "\
+                    "rebuild it with build_reddit_artifact.py" % (path,\
+                    self.manifest['version'], REDDIT_ARTIFACT_VERSION))
+        if seed not in self.manifest['seeds']:
+            raise ValueError("%s has no splits for seed %d (seeds: %s)" %\
+                    (path, seed, self.manifest['seeds']))
+        load = lambda name, mode='r': np.load(os.path.join(path, name + '.npy'),\
+                mmap_mode=mode)
+        self.path = path
+        self.edge_array = load('edges')
+        self.users = load('users')
+        self.subreddits = load('subreddits')
+        self.u_to_idx = RedditVocab(self.users)
+        self.sr_to_idx = RedditVocab(self.subreddits)
+        self.sr_degree = load('sr_degree')
+        self.sr_by_degree = load('sr_by_degree')
+        self.sr_node_rank = load('sr_node_rank')
+        self.sr_ptr = load('sr_ptr')
+        self.sr_users = load('sr_users')
+        ''' The splits become tensors through torch.from_numpy, which needs
+        writable arrays: map them copy-on-write, so writes stay private and
+        never reach the files '''
+        self.train_edges = load('train_edges_seed%d' % seed, 'c')
+        self.test_edges = load('test_edges_seed%d' % seed, 'c')
+        self.train_users = load('train_users_seed%d' % seed, 'c')
+        self.test_users = load('test_users_seed%d' % seed, 'c')
+
+    def number_of_edges(self):
+        return len(self.edge_array)
+
+    def top_subreddits(self, skip_n, num_nodes=101):
+        ''' (name, degree) of the subreddits among nodes skip_n to
+        skip_n + num_nodes when every node is sorted by degree, the slice
+        main_reddit takes of sorted(G.degree) '''
+        ranks = np.asarray(self.sr_node_rank)
+        keep = (ranks >= skip_n) & (ranks < skip_n + num_nodes)
+        srs = np.asarray(self.sr_by_degree)[keep]
+        return [(str(self.subreddits[sr]), int(self.sr_degree[sr])) for sr in srs]
+
+    def member_ids(self, sr):
+        ''' User ids of one subreddit, one CSR slice '''
+        sr = self.sr_to_idx[sr]
+        return np.asarray(self.sr_users[self.sr_ptr[sr]:self.sr_ptr[sr + 1]])
+
+    def neighbors(self, sr):
+        return iter(self.users[self.member_ids(sr)])
+
+    def sensitive_labels(self, sr):
+        ''' 0/1 label per user id: membership of subreddit `sr` '''
+        labels = np.zeros(len(self.users))
+        labels[self.member_ids(sr)] = 1
+        return labels
+
+def load_reddit_graph(path):
+    ''' RedditGraph of an .npz from create_reddit_graph's array builder, or
+    the networkx graph of a gpickle '''
+    if path.endswith('.npz'):
+        arrays = np.load(path)
+        return RedditGraph(arrays['edges'], arrays['users'], arrays['subreddits'])
+    import networkx as nx
+    return nx.read_gpickle(path)
+
+def encode_reddit_edges(edges, u_to_idx, sr_to_idx):
+    ''' (E, 2) int64 [user, sr] rows of (node, node) string edges '''
+    rows = [(u_to_idx[a], sr_to_idx[b]) if a.split('_')[0] == 'U'\
+            else (u_to_idx[b], sr_to_idx[a]) for a, b in edges]
+    return np.array(rows, dtype=np.int64).reshape(-1, 2)
+
+def load_reddit_edges(graph_fn, edges, u_to_idx, sr_to_idx):
+    ''' encode_reddit_edges of the graph stored at graph_fn, cached next to
+    it in graph_fn + '.edges.npz'. The cache is keyed by the graph file's
+    size and mtime and the vocabulary sizes, and rebuilt when they change '''
+    cache_fn = graph_fn + '.edges.npz'
+    stat = os.stat(graph_fn)
+    key = np.array([stat.st_size, int(stat.st_mtime), len(edges),\
+            len(u_to_idx), len(sr_to_idx)], dtype=np.int64)
+    if os.path.exists(cache_fn):
+        cache = np.load(cache_fn)
+        if np.array_equal(cache['key'], key):
+            return cache['edges']
+
+    encoded = encode_reddit_edges(edges, u_to_idx, sr_to_idx)
+    with open(cache_fn + '.tmp', 'wb') as f:
+        np.savez(f, key=key, edges=encoded)
+    os.rename(cache_fn + '.tmp', cache_fn)
+    return encoded
+
+def _as_triplets(data):
+    if torch.is_tensor(data):
+        data = data.cpu().numpy()
+    return np.asarray(data, dtype=np.int64).reshape(-1, 3)
+
+class KnownTriples(object):
+    ''' CSR index of observed triplets. Tails are grouped by (lhs, rel) and
+    heads by (rel, rhs); only keys that occur are stored and are looked up
+    with searchsorted '''
+    _arrays = ('hr_keys', 'hr_ptr', 'tails', 'rt_keys', 'rt_ptr', 'heads')
+
+    def __init__(self, splits, num_ent, num_rel):
+        self.num_ent = num_ent
+        self.num_rel = num_rel
+        self.shared = None
+        triplets = np.concatenate([_as_triplets(s) for s in splits])
+        lhs, rel, rhs = triplets[:,0], triplets[:,1], triplets[:,2]
+        self.hr_keys, self.hr_ptr, self.tails = self._group(lhs*num_rel + rel, rhs)
+        self.rt_keys, self.rt_ptr, self.heads = self._group(rel*num_ent + rhs, lhs)
+
+    def share_memory(self):
+        ''' Move the index arrays to shared memory; worker processes that
+        receive this object then map them instead of getting copies '''
+        self.shared = {}
+        for name in self._arrays:
+            self.shared[name] = torch.from_numpy(getattr(self, name)).clone().share_memory_()
+            setattr(self, name, self.shared[name].numpy())
+        return self
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.shared is not None:
+            for name in self._arrays:
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            for name in self._arrays:
+                setattr(self, name, self.shared[name].numpy())
+
+    def _group(self, keys, vals):
+        order = np.lexsort((vals, keys))
+        keys, vals = keys[order], vals[order]
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (vals[1:] != vals[:-1])
+        keys, vals = keys[keep], vals[keep]
+        uniq, starts = np.unique(keys, return_index=True)
+        indptr = np.append(starts, len(keys)).astype(np.int64)
+        if self.num_ent < 2**31:
+            vals = vals.astype(np.int32)
+        return uniq, indptr, vals
+
+    def known_pairs(self, queries, side):
+        ''' (row, entity) pairs of known triplets obtained by replacing
+        column `side` (0 = lhs, 2 = rhs) of each query '''
+        queries = _as_triplets(queries)
+        if side == 0:
+            uniq, indptr, vals = self.rt_keys, self.rt_ptr, self.heads
+            qkeys = queries[:,1]*self.num_ent + queries[:,2]
+        else:
+            uniq, indptr, vals = self.hr_keys, self.hr_ptr, self.tails
+            qkeys = queries[:,0]*self.num_rel + queries[:,1]
+
+        pos = np.searchsorted(uniq, qkeys)
+        pos = np.minimum(pos, len(uniq) - 1)
+        found = uniq[pos] == qkeys
+        starts = np.where(found, indptr[pos], 0)
+        counts = np.where(found, indptr[pos + 1] - indptr[pos], 0)
+        offsets = np.cumsum(counts) - counts
+        rows = np.repeat(np.arange(len(queries)), counts)
+        idx = np.arange(counts.sum()) - np.repeat(offsets, counts) + np.repeat(starts, counts)
+        return rows, vals[idx].astype(np.int64)
+
+    def known_spans(self, queries, side, device=None):
+        ''' Known pairs of a batch resolved once for a chunked sweep: sorted
+        by entity, with the entities kept on the host to find the span of a
+        chunk and (row, entity) copies on `device` to scatter it '''
+        rows, ents = self.known_pairs(queries, side)
+        order = np.argsort(ents, kind='stable')
+        rows, ents = rows[order], ents[order]
+        return ents, torch.from_numpy(rows).to(device), torch.from_numpy(ents).to(device)
+
+    def filter_mask(self, queries, side, device=None, start=0, stop=None, spans=None):
+        ''' Boolean (B, stop - start) mask of known candidates among entities
+        [start, stop), built on `device` by scattering only the known pairs.
+        Sweeps pass the batch's known_spans so each chunk is a slice '''
+        if stop is None:
+            stop = self.num_ent
+        if spans is None:
+            spans = self.known_spans(queries, side, device=device)
+        host_ents, rows, ents = spans
+        lo, hi = np.searchsorted(host_ents, [start, stop])
+        mask = torch.zeros(len(queries), stop - start, dtype=torch.bool,\
+                device=device)
+        mask[rows[lo:hi], ents[lo:hi] - start] = True
+        return mask
+
+    def __contains__(self, triplet):
+        lhs, rel, rhs = [int(x) for x in triplet]
+        key = lhs*self.num_rel + rel
+        pos = np.searchsorted(self.hr_keys, key)
+        if pos == len(self.hr_keys) or self.hr_keys[pos] != key:
+            return False
+        tails = self.tails[self.hr_ptr[pos]:self.hr_ptr[pos + 1]]
+        i = np.searchsorted(tails, rhs)
+        return i < len(tails) and tails[i] == rhs
+
+class PackedKeys(object):
+    ''' Sorted int64 keys of integer rows packed in mixed radix `sizes`,
+    e.g. (num_ent, num_rel, num_ent) for triplets or (num_users, num_sr)
+    for Reddit edges. The keys live on `device`, so a whole batch is tested
+    for membership with one searchsorted '''
+    def __init__(self, rows, sizes, device=None):
+        assert np.prod([float(n) for n in sizes]) < 2**63
+        self.sizes = sizes
+        if not torch.is_tensor(rows):
+            rows = torch.from_numpy(np.asarray(rows, dtype=np.int64))
+        self.keys = torch.unique(self.pack(rows.cpu().long())).to(device)
+
+    def pack(self, rows):
+        keys = rows[:, 0].long()
+        for j in range(1, len(self.sizes)):
+            keys = keys * self.sizes[j] + rows[:, j]
+        return keys
+
+    def stride(self, col):
+        ''' Key increment of a unit step in column `col` '''
+        return int(np.prod(self.sizes[col+1:], dtype=np.int64))
+
+    def contains(self, rows):
+        ''' Boolean tensor marking the rows that are known, on the device
+        of the keys '''
+        return self.contains_keys(self.pack(rows.to(self.keys.device)))
+
+    def contains_keys(self, keys):
+        ''' contains() for keys that are already packed, of any shape '''
+        keys = keys.to(self.keys.device)
+        pos = torch.searchsorted(self.keys, keys.reshape(-1))
+        pos = pos.clamp(max=len(self.keys) - 1).view_as(keys)
+        return self.keys[pos] == keys
+
 def compute_rank(enrgs, target, mask_observed=None):
     enrg = enrgs[target]
     if mask_observed is not None:
@@ -199,6 +583,25 @@ def compute_rank(enrgs, target, mask_observed=None):
 
     return (enrgs < enrg).sum() + 1
 
+def count_better(enrgs, enrg, mask_observed):
+    ''' Per row, the number of unmasked candidates scoring strictly better
+    than and equal to the (B, 1) target energies `enrg` '''
+    keep = ~mask_observed
+    n_better = ((enrgs < enrg) & keep).sum(dim=1)
+    n_equal = ((enrgs == enrg) & keep).sum(dim=1)
+    return n_better, n_equal
+
+def rank_from_counts(n_better, n_equal, ties='optimistic'):
+    ''' Ranks from count_better; ties with the target count as 'optimistic'
+    (the compute_rank convention), 'pessimistic' or 'realistic' (their mean) '''
+    if ties == 'optimistic':
+        return n_better + 1
+    elif ties == 'pessimistic':
+        return n_better + n_equal + 1
+    elif ties == 'realistic':
+        return n_better.float() + n_equal.float() / 2 + 1
+    else:
+        raise ValueError("unknown ties mode %r" % ties)
 
 def create_or_append(d, k, v, v2np=None):
     if v2np is None: